@@ -1,9 +1,12 @@
 import math
+import copy
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
 
 import numpy as np
 
@@ -65,6 +68,115 @@ def init_bn(bn):
     bn.weight.data.fill_(1.)
 
 ######################
+class SplitBatchNorm2d(nn.BatchNorm2d):
+    def __init__(self, *args, **kwargs):
+        """BatchNorm2d which, in training, normalizes num_splits equal parts
+        of the mini-batch with their own statistics, as if each part was
+        forwarded on its own. Used to forward clean and adversarial inputs in
+        one batch.
+        """
+        super(SplitBatchNorm2d, self).__init__(*args, **kwargs)
+
+        self.num_splits = 1
+
+    def forward(self, input):
+
+        if not self.training or self.num_splits == 1:
+            return super(SplitBatchNorm2d, self).forward(input)
+
+        return torch.cat([super(SplitBatchNorm2d, self).forward(x)
+                          for x in input.chunk(self.num_splits, dim=0)], dim=0)
+
+
+def convert_split_batchnorm(module):
+    """Replace the BatchNorm2d layers of a module with SplitBatchNorm2d layers
+    holding the same parameters and statistics.
+    """
+
+    for (name, child) in module.named_children():
+
+        if type(child) is nn.BatchNorm2d:
+            bn = SplitBatchNorm2d(child.num_features, eps=child.eps,
+                                  momentum=child.momentum, affine=child.affine,
+                                  track_running_stats=child.track_running_stats)
+            bn.load_state_dict(child.state_dict())
+            setattr(module, name, bn)
+
+        else:
+            convert_split_batchnorm(child)
+
+    return module
+
+
+def set_batchnorm_splits(module, num_splits):
+
+    for layer in module.modules():
+        if isinstance(layer, SplitBatchNorm2d):
+            layer.num_splits = num_splits
+
+
+class ExportModel(nn.Module):
+    def __init__(self, model, mean, std):
+        """A model taking unnormalized log mel features, with the scalar of 
+        its training data as buffers, and returning the log probabilities. 
+        Exported to TorchScript or ONNX, it is run without the training code. 
+        
+        Args:
+          model: trained model
+          mean: (mel_bins,)
+          std: (mel_bins,)
+        """
+        super(ExportModel, self).__init__()
+        
+        self.model = model
+        self.register_buffer('mean', torch.Tensor(mean))
+        self.register_buffer('std', torch.Tensor(std))
+        
+    def forward(self, input):
+        """input: (samples_num, seq_len, mel_bins)
+        """
+        
+        x = (input - self.mean) / self.std
+        
+        (output, _) = self.model(x)
+        
+        return output
+
+
+def quantize_model(model, calibration_batches, backend='x86'):
+    """Static post-training INT8 quantization in FX graph mode. Observers are 
+    inserted into a traced copy of the model and record the ranges of the 
+    activations on the calibration batches, then the model is converted to 
+    quantized modules, with BatchNorm folded into the convolutions. 
+    
+    The quantized model runs on cpu and has no gradient, adversarial examples 
+    for it are generated on the fp32 model. 
+    
+    Args:
+      model: fp32 model, not modified
+      calibration_batches: list of (batch_size, seq_len, mel_bins) tensors, 
+        normalized as the training data
+      backend: 'x86' | 'fbgemm' | 'qnnpack', quantized engine of the target 
+        cpu
+      
+    Returns:
+      quantized torch.fx.GraphModule
+    """
+    
+    torch.backends.quantized.engine = backend
+    
+    model = copy.deepcopy(model).cpu().eval()
+    
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), 
+                          example_inputs=(calibration_batches[0],))
+                          
+    with torch.no_grad():
+        for batch_x in calibration_batches:
+            prepared(batch_x)
+            
+    return convert_fx(prepared)
+
+
 class FGSMAttack(object):
     def __init__(self, model=None, epsilon=None, alpha=None):
         """
@@ -72,31 +184,160 @@ class FGSMAttack(object):
         """
         self.model = model
         self.epsilon = epsilon
-	self.alpha = alpha
+        self.alpha = alpha
 
-    def perturb(self, X_nat, y, epsilons=None, cuda=False):
+    def perturb(self, X_nat, y, epsilons=None):
         """
-        Given examples (X_nat, y), returns their adversarial
-        counterparts with an attack length of epsilon.
+        Given examples (X_nat, y) on the device of the model, returns their
+        adversarial counterparts with an attack length of epsilon. If y is
+        None, the predictions of the model are used as labels.
+
+        The gradient is taken with respect to the input only, on the model
+        itself in eval mode, so the model is not copied and its parameter
+        gradients are left untouched.
         """
 
         # Providing epsilons in batch
         if epsilons is not None:
             self.epsilon = epsilons
 
-        X = np.copy(X_nat)
+        X_nat = X_nat.detach()
+        X = X_nat.clone().requires_grad_(True)
+
+        training = self.model.training
+        self.model.eval()
+
+        with torch.enable_grad():
+            output, _ = self.model(X)
+            if y is None:
+                y = output.detach().argmax(dim=-1)
+
+            loss = F.nll_loss(output, y)
+            (grad,) = torch.autograd.grad(loss, X)
+
+        self.model.train(training)
+
+        X = X.detach()
+        X.add_(self.epsilon * grad.sign())
+        torch.min(X, X_nat + self.alpha, out=X)
+        torch.max(X, X_nat - self.alpha, out=X) # not (0, 1)
+
+        return X
+
+class PGDAttack(object):
+    def __init__(self, model=None, epsilon=None, alpha=None, steps=10,
+                 random_start=False, restarts=1, batch_size=None):
+        """
+        Multi step projected gradient descent (basic iterative method when
+        random_start is False). epsilon is the step length of each step and
+        alpha the radius of the ball around the clean input, as in
+        FGSMAttack.
+
+        Args:
+          steps: int, number of gradient steps
+          random_start: bool, start from a uniform point in the ball
+          restarts: int, number of attacks run for each example, the
+            strongest one is returned
+          batch_size: int, maximum number of inputs forwarded at once, None
+            forwards all restarts of a mini-batch together
+        """
+        self.model = model
+        self.epsilon = epsilon
+        self.alpha = alpha
+        self.steps = steps
+        self.random_start = random_start
+        self.restarts = restarts
+        self.batch_size = batch_size
+
+    def forward_loss(self, X, y):
+        """Per example loss and prediction of the model. """
+
+        chunk = self.batch_size or len(X)
+
+        losses = []
+        predictions = []
+
+        for n in range(0, len(X), chunk):
+            output, _ = self.model(X[n : n + chunk])
+            losses.append(F.nll_loss(output, y[n : n + chunk], reduction='none'))
+            predictions.append(output.argmax(dim=-1))
+
+        return torch.cat(losses), torch.cat(predictions)
+
+    def perturb(self, X_nat, y, epsilons=None):
+        """
+        Given examples (X_nat, y) on the device of the model, returns their
+        adversarial counterparts. If y is None, the predictions of the model
+        are used as labels.
+
+        All restarts of the mini-batch are stacked and attacked together.
+        Inputs which are already misclassified are not stepped any more, so
+        they leave the forward and backward passes of the following steps.
+        """
+
+        # Providing epsilons in batch
+        if epsilons is not None:
+            self.epsilon = epsilons
+
+        X_nat = X_nat.detach()
+        batch_num = len(X_nat)
+
+        training = self.model.training
+        self.model.eval()
+
+        if y is None:
+            with torch.no_grad():
+                output, _ = self.model(X_nat)
+                y = output.argmax(dim=-1)
+
+        # (restarts * batch_size, ...), restart r of example n is at row
+        # r * batch_size + n
+        X_nat = X_nat.repeat((self.restarts,) + (1,) * (X_nat.dim() - 1))
+        y = y.repeat(self.restarts)
+
+        X = X_nat.clone()
+
+        if self.random_start:
+            X.add_(torch.empty_like(X).uniform_(-self.alpha, self.alpha))
+
+        active = torch.arange(len(X), device=X.device)
+
+        for step in range(self.steps):
+
+            X_active = X[active].requires_grad_(True)
+
+            with torch.enable_grad():
+                (loss, prediction) = self.forward_loss(X_active, y[active])
+
+                # Sum so that the gradient of each example does not depend on
+                # the number of active examples
+                (grad,) = torch.autograd.grad(loss.sum(), X_active)
+
+            # Early exit of the examples which are already misclassified
+            keep = prediction == y[active]
+            active = active[keep]
+
+            if len(active) == 0:
+                break
+
+            X_active = X_active.detach()[keep]
+            X_active.add_(self.epsilon * grad[keep].sign())
+            torch.min(X_active, X_nat[active] + self.alpha, out=X_active)
+            torch.max(X_active, X_nat[active] - self.alpha, out=X_active)
+            X[active] = X_active
+
+        if self.restarts > 1:
 
-        X_var = move_data_to_gpu(torch.from_numpy(X), cuda)
-        y_var = move_data_to_gpu(torch.from_numpy(y), cuda)
-        X_var.requires_grad = True
+            # Keep the strongest restart of each example: misclassified first,
+            # then the one with the largest loss
+            with torch.no_grad():
+                (loss, prediction) = self.forward_loss(X, y)
 
-        output, _ = self.model(X_var)
-        loss = F.nll_loss(output, y_var)
-        loss.backward()
-        grad_sign = X_var.grad.data.cpu().sign().numpy()
+            score = loss + (prediction != y).float() * (loss.max() + 1)
+            best = score.view(self.restarts, batch_num).argmax(dim=0)
+            X = X[best * batch_num + torch.arange(batch_num, device=X.device)]
 
-        X += self.epsilon * grad_sign
-        X = np.clip(X, X_nat - self.alpha, X_nat + self.alpha) # not (0, 1)
+        self.model.train(training)
 
         return X
 
@@ -172,7 +413,7 @@ class BaselineCnn(nn.Module):
         #x = F.max_pool2d(x, kernel_size=x.shape[2:])
         #x = x.view(x.shape[0:2])
 
-	x = x.view(x.size(0), x.size(1) * x.size(2) * x.size(3))
+        x = x.view(x.size(0), x.size(1) * x.size(2) * x.size(3))
 
         x = F.log_softmax(self.fc1(x), dim=-1)
 
@@ -458,8 +699,8 @@ class ResNet(nn.Module):
         x = self.avgpool(x)
         x = torch.flatten(x, 1)
         output = self.fc(x)
-	
-	output = F.log_softmax(output, dim=-1)
+        
+        output = F.log_softmax(output, dim=-1)
 
         return output, x
 
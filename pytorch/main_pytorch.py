@@ -7,61 +7,93 @@ import h5py
 import math
 import time
 import logging
+import glob
 import copy
+import multiprocessing
+import queue
+import itertools
+import importlib.util
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
-from data_generator import DataGenerator, TestDataGenerator
+from data_generator import DataGenerator, TestDataGenerator, Prefetcher, replay_generator
 from utilities import (create_folder, get_filename, create_logging,
                        calculate_confusion_matrix, calculate_accuracy, 
-                       plot_confusion_matrix, print_accuracy, 
+                       calculate_metrics, 
+                       plot_confusion_matrix, print_accuracy, scale, read_audio_blocks, 
+                       read_audio, 
                        write_leaderboard_submission, write_evaluation_submission)
-from models_pytorch import move_data_to_gpu, DecisionLevelMaxPooling, FGSMAttack, ResNet, Vggish
+from features import (init_worker, calculate_worker_logmel, repeat_feature, 
+                      LogMelExtractor, generate_windows)
+from serving import run_server
+from graph_runner import GraphRunner
+from models_pytorch import (move_data_to_gpu, quantize_model, ExportModel, DecisionLevelMaxPooling, FGSMAttack, PGDAttack, ResNet, Vggish,
+                            convert_split_batchnorm, set_batchnorm_splits, LogMelFrontEnd)
 import config
 from torch.autograd import Variable
 
 Model = Vggish # ResNet #DecisionLevelMaxPooling
 batch_size = 16
+default_loss_weights = [0.5, 0.5]
 #epsilon_value = 0.1
 #alpha_value = 0.05
 
-def evaluate(model, model_adv, generator, data_type, devices, max_iteration, cuda):
+def evaluate(model, model_adv, generator, data_type, devices, max_iteration, cuda, 
+             prefetch=0, audio_indexes=None, source_model=None):
     """Evaluate
     
     Args:
       model: object.
+      model_adv: object, adversary. None to evaluate on clean data only
       generator: object.
       data_type: 'train' | 'validate'.
       devices: list of devices, e.g. ['a'] | ['a', 'b', 'c']
       max_iteration: int, maximum iteration for validation
       cuda: bool.
+      prefetch: int, number of mini-batches prepared in advance, 0 for none
+      audio_indexes: list | array of int, audios to evaluate, None for all 
+        audios of data_type
+      source_model: object | None, model the adversarial examples are 
+        generated on, None for model itself
       
     Returns:
       accuracy: float
+      loss: float
+      accuracy_adv: float, None if model_adv is None
+      loss_adv: float, None if model_adv is None
     """
     
     # Generate function
     generate_func = generator.generate_validate(data_type=data_type, 
                                                 devices=devices, 
                                                 shuffle=True, 
-                                                max_iteration=max_iteration)
+                                                max_iteration=max_iteration, 
+                                                audio_indexes=audio_indexes)
+
+    if prefetch > 0:
+        generate_func = Prefetcher(generate_func, queue_depth=prefetch, 
+                                   pin_memory=cuda)
             
+    audios_num = generator.get_audios_num(data_type=data_type, 
+                                          max_iteration=max_iteration, 
+                                          audio_indexes=audio_indexes)
+
     # Forward
     dict = forward(model=model, 
-		   model_adv=model_adv,
+                   model_adv=model_adv,
                    generate_func=generate_func, 
                    cuda=cuda, 
-                   return_target=True)
+                   return_target=True, 
+                   audios_num=audios_num, 
+                   source_model=source_model)
 
     outputs = dict['output']    # (audios_num, classes_num)
-    outputs_adv = dict['output_adv']    # (audios_num, classes_num)
     targets = dict['target']    # (audios_num, classes_num)
     
     predictions = np.argmax(outputs, axis=-1)   # (audios_num,)
-    predictions_adv = np.argmax(outputs_adv, axis=-1)   # (audios_num,)
 
     # Evaluate
     classes_num = outputs.shape[-1]
@@ -70,41 +102,95 @@ def evaluate(model, model_adv, generator, data_type, devices, max_iteration, cud
 
     loss = float(loss)
 
+    accuracy = calculate_metrics(targets, predictions, 
+                                 classes_num)['macro_accuracy']
+
+    if model_adv is None:
+        return accuracy, loss, None, None
+
+    outputs_adv = dict['output_adv']    # (audios_num, classes_num)
+    predictions_adv = np.argmax(outputs_adv, axis=-1)   # (audios_num,)
+
     loss_adv = F.nll_loss(Variable(torch.Tensor(outputs_adv)), Variable(torch.LongTensor(targets))).data.numpy()
 
     loss_adv = float(loss_adv)
 
-    confusion_matrix = calculate_confusion_matrix(
-        targets, predictions, classes_num)
-    
-    accuracy = calculate_accuracy(targets, predictions, classes_num, 
-                                  average='macro')
-
-    accuracy_adv = calculate_accuracy(targets, predictions_adv, classes_num, 
-                                  average='macro')
+    accuracy_adv = calculate_metrics(targets, predictions_adv, 
+                                     classes_num)['macro_accuracy']
 
     return accuracy, loss, accuracy_adv, loss_adv
 
 # forward: model_pytorch---        Return_heatmap = False
 # forward_heatmap: model_pytorch---        Return_heatmap = True
-def forward(model, model_adv, generate_func, cuda, return_target):
+def get_adversary(args, model=None):
+    """Attack used for adversarial training and evaluation.
+
+    Args:
+      args: parsed arguments, the attack is selected by args.attack
+      model: model to attack, can also be set later through adversary.model
+
+    Returns:
+      FGSMAttack or PGDAttack
+    """
+
+    if args.attack == 'fgsm':
+        return FGSMAttack(model=model, epsilon=args.epsilon_value,
+                          alpha=args.alpha_value)
+
+    elif args.attack == 'pgd':
+        return PGDAttack(model=model, epsilon=args.epsilon_value,
+                         alpha=args.alpha_value, steps=args.pgd_steps,
+                         random_start=args.random_start,
+                         restarts=args.pgd_restarts)
+
+    else:
+        raise Exception('Incorrect attack!')
+
+
+def allocate_output(shape, dtype, path=None):
+    """Array of forward() outputs, in memory or as a .npy memmap at path. """
+
+    if path is None:
+        return np.empty(shape, dtype=dtype)
+
+    else:
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, 
+                                         shape=shape)
+
+
+def get_adversary_config(args):
+    """Arguments of the adversary, saved in checkpoints. """
+
+    return {key: getattr(args, key) for key in ['attack', 'epsilon_value', 
+        'alpha_value', 'pgd_steps', 'pgd_restarts', 'random_start', 
+        'adv_train', 'replay_times']}
+
+
+def forward(model, model_adv, generate_func, cuda, return_target, audios_num, 
+            output_dir=None, source_model=None):
     """Forward data to a model.
     
     Args:
       generate_func: generate function
       cuda: bool
       return_target: bool
+      audios_num: int, number of audios yielded by generate_func, the 
+        outputs are written to arrays of this length allocated once
+      output_dir: str | None, write the outputs to .npy memmaps in this 
+        directory instead of memory, so that memory stays flat for large 
+        evaluation sets
+      source_model: object | None, model the adversarial examples are 
+        generated on, e.g. the fp32 model of a quantized model, None for 
+        model itself
       
     Returns:
-      dict, keys: 'audio_name', 'output'; optional keys: 'target'
+      dict, keys: 'audio_name', 'output'; optional keys: 'target', 
+        'output_adv' if model_adv is not None
     """
     
-    outputs = []
+    dict = {}
     audio_names = []
-    outputs_adv = []
-    
-    if return_target:
-        targets = []
+    pointer = 0
     
     # Evaluate on mini-batch
     for data in generate_func:
@@ -119,81 +205,223 @@ def forward(model, model_adv, generate_func, cuda, return_target):
 
         # Predict
         model.eval()
-        batch_output = model(batch_x)
-	
-	# advesarial predict
-        batch_y_pred = np.argmax(batch_output.data.cpu().numpy(), axis=-1)
-        batch_y_pred = move_data_to_gpu(batch_y_pred, cuda)
-
-        model_cp = copy.deepcopy(model)
-        for p in model_cp.parameters():
-            p.requires_grad = False
-        model_cp.eval()
-
-        model_adv.model = model_cp
-        del model_cp
-
-        batch_x_adv = model_adv.perturb(batch_x.data.cpu().numpy(), batch_y_pred.data.cpu().numpy(), cuda=cuda)
-        batch_x_adv = move_data_to_gpu(batch_x_adv, cuda)
-        batch_output_adv = model(batch_x_adv)
-
-        # Append data
-        outputs.append(batch_output.data.cpu().numpy())
-        audio_names.append(batch_audio_names)
-        outputs_adv.append(batch_output_adv.data.cpu().numpy())        
 
-        if return_target:
-            targets.append(batch_y)
+        with torch.no_grad():
+            batch_output = model(batch_x)
+        
+        batch_dict = {'output': batch_output.data.cpu().numpy()}
 
-        dict = {}
+        # advesarial predict
+        if model_adv is not None:
+            batch_y_pred = batch_output.argmax(dim=-1)
 
-        outputs = np.concatenate(outputs, axis=0)
-        dict['output'] = outputs
-        
-        audio_names = np.concatenate(audio_names, axis=0)
-        dict['audio_name'] = audio_names
+            if source_model is None:
+                model_adv.model = model
+            else:
+                model_adv.model = source_model
+                
+            batch_x_adv = model_adv.perturb(batch_x, batch_y_pred)
+
+            with torch.no_grad():
+                batch_output_adv = model(batch_x_adv)
+
+            batch_dict['output_adv'] = batch_output_adv.data.cpu().numpy()
 
-        outputs_adv = np.concatenate(outputs_adv, axis=0)
-        dict['output_adv'] = outputs_adv
-        
         if return_target:
-            targets = np.concatenate(targets, axis=0)
-            dict['target'] = targets
+            batch_dict['target'] = np.asarray(batch_y)
+
+        # Allocate outputs from the shapes of the first mini-batch
+        if pointer == 0:
+            for (key, value) in batch_dict.items():
+
+                if output_dir is None:
+                    path = None
+
+                else:
+                    path = os.path.join(output_dir, '{}.npy'.format(key))
+
+                dict[key] = allocate_output((audios_num,) + value.shape[1:], 
+                                            value.dtype, path)
+
+        # Write data
+        batch_audios_num = len(batch_audio_names)
+
+        for (key, value) in batch_dict.items():
+            dict[key][pointer : pointer + batch_audios_num] = value
+
+        audio_names.append(batch_audio_names)
+        pointer += batch_audios_num
+
+    for key in dict.keys():
+        if output_dir is not None:
+            dict[key].flush()
+
+        dict[key] = dict[key][0 : pointer]
+
+    dict['audio_name'] = np.concatenate(audio_names, axis=0)
             
-        return dict
+    return dict
+
 
+def evaluate_and_log(model, adversary, generator, devices, cuda, prefetch, 
+                     train_audio_indexes, train_attack, tag=''):
+    """Evaluate on the training and the validation data and log the results.
+    
+    Args:
+      train_audio_indexes: list | array of int, training audios to evaluate, 
+        None for all of them
+      train_attack: bool, evaluate the training audios under attack
+      tag: str, prefix of the logged lines
+    """
 
+    (tr_acc, tr_loss, tr_acc_adv, tr_loss_adv) = evaluate(model=model,
+                                 model_adv=adversary if train_attack else None,
+                                 generator=generator,
+                                 data_type='train',
+                                 devices=devices,
+                                 max_iteration=None,
+                                 cuda=cuda,
+                                 prefetch=prefetch,
+                                 audio_indexes=train_audio_indexes)
 
-def train(args):
+    if train_attack:
+        logging.info('{}tr_acc: {:.3f}, tr_loss: {:.3f}, tr_acc_adv: {:.3f}, tr_loss_adv: {:.3f}'.format(
+            tag, tr_acc, tr_loss, tr_acc_adv, tr_loss_adv))
+
+    else:
+        logging.info('{}tr_acc: {:.3f}, tr_loss: {:.3f}'.format(
+            tag, tr_acc, tr_loss))
+
+    (va_acc, va_loss, va_acc_adv, va_loss_adv) = evaluate(model=model,
+                                model_adv=adversary,
+                                generator=generator,
+                                data_type='validate',
+                                devices=devices,
+                                max_iteration=None,
+                                cuda=cuda,
+                                prefetch=prefetch)
+
+    logging.info('{}va_acc: {:.3f}, va_loss: {:.3f}, va_acc_adv: {:.3f}, va_loss_adv: {:.3f}'.format(
+        tag, va_acc, va_loss, va_acc_adv, va_loss_adv))
+
+
+def put_snapshot(snapshot_queue, evaluator, snapshot, timeout=1.):
+    """Put a snapshot to the evaluation process of --async_eval. Waits while 
+    the queue is full, but raises once the evaluation process has exited, 
+    e.g. after an exception or being killed, instead of blocking forever.
+    """
+
+    while True:
+        try:
+            snapshot_queue.put(snapshot, timeout=timeout)
+            return
+
+        except queue.Full:
+            if not evaluator.is_alive():
+                raise Exception('Evaluation process exited with code {}!'.format(
+                    evaluator.exitcode))
+
+
+def evaluate_process(args, generator, devices, classes_num, snapshot_queue, 
+                     train_audio_indexes, train_attack):
+    """Evaluation process of --async_eval. Evaluates the (iteration, 
+    state_dict) snapshots put in snapshot_queue until None is put. The 
+    process is forked, so it shares the features loaded by the generator.
+    """
+
+    generator.reopen()
+
+    model = Model(classes_num)
+    adversary = get_adversary(args, model=model)
+
+    if args.cuda:
+        model.cuda()
+
+    while True:
+
+        snapshot = snapshot_queue.get()
+
+        if snapshot is None:
+            break
+
+        (iteration, state_dict) = snapshot
+        model.load_state_dict(state_dict)
+
+        evaluate_time = time.time()
+
+        evaluate_and_log(model=model,
+                         adversary=adversary,
+                         generator=generator,
+                         devices=devices,
+                         cuda=args.cuda,
+                         prefetch=args.prefetch,
+                         train_audio_indexes=train_audio_indexes,
+                         train_attack=train_attack,
+                         tag='iteration: {}, '.format(iteration))
+
+        logging.info('iteration: {}, evaluate time: {:.3f} s'.format(
+            iteration, time.time() - evaluate_time))
+
+
+def forward_fused(model, batch_x, batch_x_adv):
+    """Forward clean and adversarial inputs to a model as one batch.
+
+    Args:
+      batch_x: (batch_size, seq_len, freq_bins), clean inputs
+      batch_x_adv: (batch_size, seq_len, freq_bins), adversarial inputs
+
+    Returns:
+      batch_output, batch_output_adv
+    """
+
+    set_batchnorm_splits(model, 2)
+    batch_output = model(torch.cat((batch_x, batch_x_adv), dim=0))
+    set_batchnorm_splits(model, 1)
+
+    return batch_output.chunk(2, dim=0)
+
+def get_run_name(args):
+    """Directory name of a training run, e.g. 'epsilon=0.1-alpha=0.05'. Loss 
+    weights other than the default ones are appended.
+    """
+
+    run_name = 'epsilon={}-alpha={}'.format(args.epsilon_value, args.alpha_value)
+
+    if list(args.loss_weights) != default_loss_weights:
+        run_name += '-weights={}'.format(
+            ','.join(str(weight) for weight in args.loss_weights))
+
+    return run_name
+
+
+def get_train_paths(args):
+    """Paths of a training run.
+
+    Returns:
+      hdf5_path: str, development features
+      dev_train_csv: str
+      dev_validate_csv: str
+      models_dir: str
+    """
 
-    # Arugments & parameters
     dataset_dir = args.dataset_dir
-    # subdir = args.subdir
+    subdir = args.subdir
     workspace = args.workspace
     feature_type = args.feature_type
     filename = args.filename
     validation = args.validation
     holdout_fold = args.holdout_fold
-    epsilon_value = args.epsilon_value
-    alpha_value = args.alpha_value
     mini_data = args.mini_data
-    cuda = args.cuda
-
-    labels = config.labels
-
-    # #ign mobile
-    # if 'mobile' in subdir:
-    #     devices = ['a', 'b', 'c']
-    # else:
-    #     devices = ['a']
 
-    classes_num = len(labels)
+    if validation and (dataset_dir is None or subdir is None):
+        raise Exception('--dataset_dir and --subdir are required with --validation!')
 
     # Paths ign
     # if mini_data:
     #     hdf5_path = os.path.join(workspace, 'features', feature_type, 'mini_development.h5')
     # else:
     #     hdf5_path = os.path.join(workspace, 'features', feature_type, 'development.h5')
+    hdf5_path = os.path.join(workspace, 'features', feature_type, 'development.h5')
 
     if validation: 
         
@@ -204,7 +432,7 @@ def train(args):
                                     'fold{}_devel.txt'.format(holdout_fold))
                               
         models_dir = os.path.join(workspace, 'models', subdir, filename,
-                                  'holdout_fold={}'.format(holdout_fold), 'epsilon={}-alpha={}'.format(epsilon_value, alpha_value))
+                                  'holdout_fold={}'.format(holdout_fold), get_run_name(args))
                                         
     else:
         # dev_train_csv = os.path.join(dataset_dir, subdir, 'evaluation_setup',
@@ -216,59 +444,224 @@ def train(args):
         dev_validate_csv = "/home/nwang/emotion/dev_dataset.csv"
         
         models_dir = os.path.join(workspace, 'models', filename,
-                                  'full_train', 'epsilon={}-alpha={}'.format(epsilon_value, alpha_value))
+                                  'full_train', get_run_name(args))
+
+    return hdf5_path, dev_train_csv, dev_validate_csv, models_dir
+
+
+def get_latest_checkpoint(models_dir):
+    """Path of the checkpoint with the most iterations in models_dir, None if 
+    there is no checkpoint.
+    """
+
+    checkpoint_paths = glob.glob(os.path.join(models_dir, 'md_*_iters.tar'))
+
+    if len(checkpoint_paths) == 0:
+        return None
+
+    return max(checkpoint_paths, key=lambda path: 
+        int(os.path.basename(path).split('_')[1]))
+
+
+def get_replay_position(iteration, replay_times, start_iteration):
+    """Mini-batch of generate_train and its replay trained at an iteration of 
+    free adversarial training.
+    """
+
+    if iteration < start_iteration:
+        return iteration, 0
+
+    else:
+        return (start_iteration + (iteration - start_iteration) // replay_times, 
+                (iteration - start_iteration) % replay_times)
+
+
+def train(args, generator=None):
+
+    # Arugments & parameters
+    dataset_dir = args.dataset_dir
+    # subdir = args.subdir
+    workspace = args.workspace
+    feature_type = args.feature_type
+    filename = args.filename
+    validation = args.validation
+    holdout_fold = args.holdout_fold
+    mini_data = args.mini_data
+    cuda = args.cuda
+    storage = args.storage
+    prefetch = args.prefetch
+    prenormalize = args.prenormalize
+    fused_forward = args.fused_forward
+    fused_bn = args.fused_bn
+    eval_interval = args.eval_interval
+    eval_train_subset = args.eval_train_subset
+    eval_train_attack = not args.no_eval_train_attack
+    async_eval = args.async_eval
+    loss_weights = args.loss_weights
+    resume = args.resume
+
+    # Adversarial training starts after training on clean data
+    adv_start_iteration = 1000
+
+    labels = config.labels
+
+    # #ign mobile
+    # if 'mobile' in subdir:
+    #     devices = ['a', 'b', 'c']
+    # else:
+    #     devices = ['a']
+
+    classes_num = len(labels)
+
+    (hdf5_path, dev_train_csv, dev_validate_csv, models_dir) = \
+        get_train_paths(args)
 
     create_folder(models_dir)
 
+    # Latest checkpoint of the run
+    checkpoint = None
+
+    if resume:
+        checkpoint_path = get_latest_checkpoint(models_dir)
+
+        if checkpoint_path is None:
+            logging.info('No checkpoint in {}, train from iteration 0'.format(
+                models_dir))
+
+        else:
+            checkpoint = torch.load(checkpoint_path, map_location='cpu')
+
+            # Continue with the adversary the run was trained with
+            for (key, value) in checkpoint.get('adversary', {}).items():
+                if getattr(args, key) != value:
+                    logging.info('Resume with {}={} of the checkpoint'.format(
+                        key, value))
+                        
+                setattr(args, key, value)
+
+            logging.info('Resume from {}'.format(checkpoint_path))
+
+    # Read after the adversary of a resumed run has been restored
+    epsilon_value = args.epsilon_value
+    alpha_value = args.alpha_value
+    adv_train = args.adv_train
+    replay_times = args.replay_times
+
     # Model
     model = Model(classes_num)
-    adversary = FGSMAttack(epsilon=epsilon_value, alpha=alpha_value)
+
+    # Clean and adversarial halves of a fused batch are normalized with their
+    # own statistics
+    if fused_forward and fused_bn == 'split':
+        convert_split_batchnorm(model)
+
+    adversary = get_adversary(args, model=model)
+
+    # Data generator, given by sweep() which loads the data once for all runs
+    if generator is None:
+        generator = DataGenerator(hdf5_path=hdf5_path,
+                                  batch_size=batch_size,
+                                  dev_train_csv=dev_train_csv,
+                                  dev_validate_csv=dev_validate_csv,
+                                  storage=storage,
+                                  prenormalize=prenormalize)
+
+    # Training audios evaluated during training. The subset is fixed for the 
+    # run, so that evaluations at different iterations are comparable
+    if eval_train_subset > 0:
+        eval_train_audio_indexes = generator.get_subset_audio_indexes(
+            data_type='train', audios_num=eval_train_subset)
+
+    else:
+        eval_train_audio_indexes = None
+
+    # The evaluation process is forked before CUDA is initialized in this 
+    # process
+    if async_eval:
+        context = multiprocessing.get_context('fork')
+        snapshot_queue = context.Queue(maxsize=2)
+
+        evaluator = context.Process(target=evaluate_process, 
+                                    args=(args, generator, ['a'], classes_num, 
+                                          snapshot_queue, 
+                                          eval_train_audio_indexes, 
+                                          eval_train_attack))
+        evaluator.start()
 
     if cuda:
         model.cuda()
 
-    # Data generator
-    hdf5_path = os.path.join(workspace, 'features', feature_type, 'development.h5')
-    generator = DataGenerator(hdf5_path=hdf5_path,
-                              batch_size=batch_size,
-                              dev_train_csv=dev_train_csv,
-                              dev_validate_csv=dev_validate_csv)
-
     # Optimizer
     lr = 1e-3
     optimizer = optim.Adam(model.parameters(), lr=lr, betas=(0.9, 0.999), eps=1e-08, weight_decay=0.)
 
     train_bgn_time = time.time()
 
-    # Train on mini batches
-    for (iteration, (batch_x, batch_y)) in enumerate(generator.generate_train()):
+    # Perturbation of free adversarial training, kept across mini-batches
+    delta = None
 
-        # Evaluate
-        if iteration % 100 == 0:
+    start_iteration = 0
+    generator_state = None
 
-            train_fin_time = time.time()
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+
+        start_iteration = checkpoint['iteration']
+        generator_state = checkpoint.get('generator')
+
+        if 'rng_state' in checkpoint:
+            torch.set_rng_state(checkpoint['rng_state'])
+
+        if cuda and checkpoint.get('cuda_rng_state') is not None:
+            torch.cuda.set_rng_state_all(checkpoint['cuda_rng_state'])
+
+        if checkpoint.get('delta') is not None:
+            delta = checkpoint['delta'].to(next(model.parameters()).device)
+
+    generate_func = generator.generate_train(state=generator_state)
 
-            (tr_acc, tr_loss, tr_acc_adv, tr_loss_adv) = evaluate(model=model,
-					 model_adv=adversary,
-                                         generator=generator,
-                                         data_type='train',
-                                         devices=['a'],
-                                         max_iteration=None,
-                                         cuda=cuda)
+    # Free adversarial training replays each mini-batch, every replay is one
+    # iteration
+    if adv_train == 'free':
+        (first_iteration, first_replay) = get_replay_position(
+            start_iteration, replay_times, adv_start_iteration)
 
-            logging.info('tr_acc: {:.3f}, tr_loss: {:.3f}, tr_acc_adv: {:.3f}, tr_loss_adv: {:.3f}'.format(
-                tr_acc, tr_loss, tr_acc_adv, tr_loss_adv))
+        generate_func = replay_generator(generate_func, 
+                                         replay_times=replay_times, 
+                                         start_iteration=adv_start_iteration, 
+                                         first_iteration=first_iteration, 
+                                         first_replay=first_replay)
 
-            (va_acc, va_loss, va_acc_adv, va_loss_adv) = evaluate(model=model,
-					model_adv=adversary,
-                                        generator=generator,
-                                        data_type='validate',
-                                        devices=['a'],
-                                        max_iteration=None,
-                                        cuda=cuda)
+    if prefetch > 0:
+        generate_func = Prefetcher(generate_func, queue_depth=prefetch, 
+                                   pin_memory=cuda)
 
-            logging.info('va_acc: {:.3f}, va_loss: {:.3f}, va_acc_adv: {:.3f}, va_loss_adv: {:.3f}'.format(
-                    va_acc, va_loss, va_acc_adv, va_loss_adv))
+    # Train on mini batches
+    for (iteration, (batch_x, batch_y)) in enumerate(generate_func, 
+                                                     start_iteration):
+
+        # Evaluate
+        if iteration % eval_interval == 0:
+
+            train_fin_time = time.time()
+
+            if async_eval:
+                # Training continues while the snapshot is evaluated
+                state_dict = {key: value.detach().cpu().clone() for 
+                              (key, value) in model.state_dict().items()}
+                              
+                put_snapshot(snapshot_queue, evaluator, (iteration, state_dict))
+
+            else:
+                evaluate_and_log(model=model,
+                                 adversary=adversary,
+                                 generator=generator,
+                                 devices=['a'],
+                                 cuda=cuda,
+                                 prefetch=prefetch,
+                                 train_audio_indexes=eval_train_audio_indexes,
+                                 train_attack=eval_train_attack)
 
             train_time = train_fin_time - train_bgn_time
             validate_time = time.time() - train_fin_time
@@ -277,6 +670,14 @@ def train(args):
                 'iteration: {}, train time: {:.3f} s, validate time: {:.3f} s'
                     ''.format(iteration, train_time, validate_time))
 
+            if prefetch > 0:
+                logging.info(
+                    'prefetch queue depth: {}, queued batches: {}, batch wait '
+                    'time: {:.3f} s'.format(prefetch, generate_func.qsize(), 
+                    generate_func.wait_time))
+                    
+                generate_func.wait_time = 0.
+
             logging.info('------------------------------------')
 
             train_bgn_time = time.time()
@@ -284,9 +685,24 @@ def train(args):
         # Save model
         if iteration % 1000 == 0 and iteration > 0:
 
+            # Mini-batch of generate_train trained at this iteration
+            if adv_train == 'free':
+                (generator_iteration, _) = get_replay_position(
+                    iteration, replay_times, adv_start_iteration)
+
+            else:
+                generator_iteration = iteration
+
             save_out_dict = {'iteration': iteration,
                              'state_dict': model.state_dict(),
-                             'optimizer': optimizer.state_dict()
+                             'optimizer': optimizer.state_dict(),
+                             'generator': generator.get_train_state(generator_iteration),
+                             'adversary': get_adversary_config(args),
+                             'rng_state': torch.get_rng_state(),
+                             'cuda_rng_state': torch.cuda.get_rng_state_all() if cuda else None,
+                             'delta': delta,
+                             'mean': torch.from_numpy(generator.mean),
+                             'std': torch.from_numpy(generator.std)
                              }
             save_out_path = os.path.join(
                 models_dir, 'md_{}_iters.tar'.format(iteration))
@@ -303,42 +719,864 @@ def train(args):
         batch_y = move_data_to_gpu(batch_y, cuda)
 
         model.train()
-        batch_output = model(batch_x)
 
-        loss = F.nll_loss(batch_output, batch_y)
+        if adv_train == 'free' and iteration >= adv_start_iteration:
+
+            # The perturbation is updated with the input gradient of the 
+            # training backward, so no separate attack pass is needed
+            if delta is None:
+                delta = torch.zeros((batch_size,) + batch_x.shape[1:], 
+                                    device=batch_x.device)
+
+            batch_delta = delta[0 : len(batch_x)]
+            batch_x_free = (batch_x + batch_delta).requires_grad_(True)
+            batch_output = model(batch_x_free)
+
+            loss = F.nll_loss(batch_output, batch_y)
+
+        elif iteration >= adv_start_iteration:
+
+            if fused_forward:
 
-        if iteration >= 1000:
-            batch_y_pred = np.argmax(batch_output.data.cpu().numpy(), axis=-1)
-            batch_y_pred = move_data_to_gpu(batch_y_pred, cuda)
+                # There is no clean output before the attack, so the attack 
+                # uses the predictions of the model as labels
+                batch_x_adv = adversary.perturb(batch_x, None)
 
-            model_cp = copy.deepcopy(model)
-            for p in model_cp.parameters():
-                p.requires_grad = False
-            model_cp.eval()
+                (batch_output, batch_output_adv) = forward_fused(
+                    model, batch_x, batch_x_adv)
 
-            adversary.model = model_cp
-            del model_cp
+            else:
+                batch_output = model(batch_x)
 
-            batch_x_adv = adversary.perturb(batch_x.data.cpu().numpy(), batch_y_pred.data.cpu().numpy(), cuda=cuda)
-            batch_x_adv = move_data_to_gpu(batch_x_adv, cuda)
-            batch_output_adv = model(batch_x_adv)
+                batch_y_pred = batch_output.detach().argmax(dim=-1)
+
+                batch_x_adv = adversary.perturb(batch_x, batch_y_pred)
+                batch_output_adv = model(batch_x_adv)
+
+            loss = F.nll_loss(batch_output, batch_y)
             loss_adv = F.nll_loss(batch_output_adv, batch_y)
 
-            loss = 0.5 * loss + 0.5 * loss_adv
+            loss = loss_weights[0] * loss + loss_weights[1] * loss_adv
 
             #if iteration % 10 == 0:
             #    logging.info('batch loss: {}, batch loss_adv: {}'.format(loss, loss_adv))
 
+        else:
+            batch_output = model(batch_x)
+            loss = F.nll_loss(batch_output, batch_y)
 
         # Backward
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
 
+        if adv_train == 'free' and iteration >= adv_start_iteration:
+            batch_delta.add_(epsilon_value * batch_x_free.grad.sign())
+            batch_delta.clamp_(-alpha_value, alpha_value)
+
         # Stop learning
         if iteration == 10000:
             break
 
+    if prefetch > 0:
+        generate_func.close()
+
+    if async_eval:
+        put_snapshot(snapshot_queue, evaluator, None)
+        evaluator.join()
+
+
+# DataGenerator shared by the runs of a sweep worker
+sweep_generator = None
+
+
+def init_sweep_worker(generator, threads):
+    """Initialize a forked sweep worker. The generator is inherited from the 
+    parent, so its features are shared copy-on-write and not loaded again.
+    """
+
+    global sweep_generator
+
+    sweep_generator = generator
+    sweep_generator.reopen()
+
+    torch.set_num_threads(threads)
+
+    # Every run logs to its own file
+    root_logger = logging.getLogger('')
+
+    for handler in root_logger.handlers[:]:
+        if isinstance(handler, logging.FileHandler):
+            root_logger.removeHandler(handler)
+
+
+def sweep_run(args):
+    """Train one run of a sweep in a sweep worker. """
+
+    run_name = get_run_name(args)
+
+    logs_dir = os.path.join(args.workspace, 'logs', args.filename, 'sweep')
+    handler = logging.FileHandler(
+        os.path.join(logs_dir, '{}.log'.format(run_name)), mode='w')
+
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s', 
+        datefmt='%a, %d %b %Y %H:%M:%S'))
+
+    root_logger = logging.getLogger('')
+    root_logger.addHandler(handler)
+
+    # Every run sees the mini-batches of a freshly created generator
+    sweep_generator.reset_random_state()
+
+    try:
+        train(args, generator=sweep_generator)
+
+    finally:
+        root_logger.removeHandler(handler)
+        handler.close()
+
+    return run_name
+
+
+def sweep(args):
+    """Train the grid of epsilon_values x alpha_values x loss_weights_values. 
+    The development data is loaded once and the runs are distributed to 
+    forked worker processes, which share the loaded features. 
+    """
+
+    # Runs
+    runs = []
+
+    for epsilon_value in args.epsilon_values:
+        for alpha_value in args.alpha_values:
+            for loss_weights in args.loss_weights_values:
+
+                run_args = copy.copy(args)
+                run_args.mode = 'train'
+                run_args.epsilon_value = epsilon_value
+                run_args.alpha_value = alpha_value
+                run_args.loss_weights = [float(weight) for weight in 
+                                         loss_weights.split(',')]
+
+                # Worker processes can not fork an evaluation process
+                run_args.async_eval = False
+
+                runs.append(run_args)
+
+    logging.info('Number of runs: {}, workers: {}'.format(len(runs), 
+                                                          args.workers))
+
+    # Data generator
+    (hdf5_path, dev_train_csv, dev_validate_csv, _) = get_train_paths(runs[0])
+
+    generator = DataGenerator(hdf5_path=hdf5_path,
+                              batch_size=batch_size,
+                              dev_train_csv=dev_train_csv,
+                              dev_validate_csv=dev_validate_csv,
+                              storage=args.storage,
+                              prenormalize=args.prenormalize)
+
+    create_folder(os.path.join(args.workspace, 'logs', args.filename, 'sweep'))
+
+    # Threads are split between the workers
+    threads = max(1, multiprocessing.cpu_count() // args.workers)
+
+    context = multiprocessing.get_context('fork')
+
+    pool = context.Pool(processes=args.workers, 
+                        initializer=init_sweep_worker, 
+                        initargs=(generator, threads))
+
+    for run_name in pool.imap_unordered(sweep_run, runs):
+        logging.info('Finish run {}'.format(run_name))
+
+    pool.close()
+    pool.join()
+
+
+def get_audio_paths(audio_dir=None, audio_list=None):
+    """Wav files of a directory, or the audio files listed one per line in a 
+    text file. 
+    """
+    
+    if audio_dir is not None:
+        audio_paths = sorted(glob.glob(os.path.join(audio_dir, '*.wav')))
+        
+    else:
+        with open(audio_list) as f:
+            audio_paths = [line.strip() for line in f if line.strip()]
+            
+    return audio_paths
+    
+    
+def generate_audio_features(audio_paths, workers, batch_audios, queue_depth):
+    """Decode audios and extract their log mel features in a pool of workers, 
+    while the caller runs inference on the features already extracted. At 
+    most queue_depth batches of audios are decoded ahead of the caller, so 
+    the memory does not grow with the number of audios. 
+    
+    Args:
+      audio_paths: list of str
+      workers: int, number of worker processes, 1 extracts in this process
+      batch_audios: int, number of audios extracted by one call of a worker
+      queue_depth: int
+      
+    Returns:
+      generator of (audio_path, feature), feature: (frames_num, mel_bins), in 
+      the order of audio_paths
+    """
+    
+    path_batches = [audio_paths[n : n + batch_audios] 
+                    for n in range(0, len(audio_paths), batch_audios)]
+                    
+    initargs = (config.sample_rate, config.window_size, config.overlap, 
+                config.mel_bins)
+    
+    if workers > 1:
+        semaphore = multiprocessing.BoundedSemaphore(queue_depth)
+        
+        def throttled_path_batches():
+            for path_batch in path_batches:
+                semaphore.acquire()
+                yield path_batch
+        
+        pool = multiprocessing.Pool(processes=workers, 
+                                    initializer=init_worker, 
+                                    initargs=initargs)
+        
+        feature_batches = pool.imap(calculate_worker_logmel, 
+                                    throttled_path_batches())
+        
+    else:
+        pool = None
+        init_worker(*initargs)
+        feature_batches = map(calculate_worker_logmel, path_batches)
+        
+    try:
+        for (path_batch, features) in zip(path_batches, feature_batches):
+            
+            if pool is not None:
+                semaphore.release()
+                
+            for (audio_path, feature) in zip(path_batch, features):
+                yield audio_path, feature
+                
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            
+            
+def get_checkpoint_scalar(checkpoint, scalar_path=None):
+    """Mean and std of the training data of a checkpoint. Checkpoints saved 
+    without them need the scalar cached next to the features, scalar_path. 
+    """
+    
+    if 'mean' in checkpoint:
+        return checkpoint['mean'].numpy(), checkpoint['std'].numpy()
+        
+    elif scalar_path is not None:
+        scalar = np.load(scalar_path)
+        return scalar['mean'], scalar['std']
+        
+    else:
+        raise Exception('The checkpoint has no scalar, give --scalar_path!')
+
+
+def predict_batch(model, batch_x, mean, std, cuda):
+    """Class probabilities of a mini-batch of unnormalized features. 
+    
+    Returns:
+      (batch_size, classes_num)
+    """
+    
+    batch_x = scale(batch_x, mean, std)
+    batch_x = move_data_to_gpu(batch_x, cuda)
+    
+    model.eval()
+    
+    with torch.no_grad():
+        output = model(batch_x)
+        
+    return torch.exp(output).data.cpu().numpy()
+
+
+def predict(args):
+    """Predict the labels of raw audio files with a trained checkpoint and 
+    write the labels and the probabilities of all classes to a submission 
+    file. 
+    """
+    
+    # Arguments & parameters
+    checkpoint_path = args.checkpoint_path
+    audio_dir = args.audio_dir
+    audio_list = args.audio_list
+    scalar_path = args.scalar_path
+    submission_path = args.submission_path
+    workers = args.workers
+    prefetch = args.prefetch
+    cuda = args.cuda
+    
+    seq_len = config.seq_len
+    mel_bins = config.mel_bins
+    classes_num = len(config.labels)
+    batch_audios = 4
+    
+    if (audio_dir is None) == (audio_list is None):
+        raise Exception('Give one of --audio_dir and --audio_list!')
+    
+    # Load model
+    model = Model(classes_num)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(checkpoint['state_dict'])
+    
+    if cuda:
+        model.cuda()
+        
+    (mean, std) = get_checkpoint_scalar(checkpoint, scalar_path)
+        
+    audio_paths = get_audio_paths(audio_dir, audio_list)
+    audios_num = len(audio_paths)
+    logging.info('Number of audios: {}'.format(audios_num))
+    
+    probabilities = np.zeros((audios_num, classes_num), dtype=np.float32)
+    batch_x = np.zeros((batch_size, seq_len, mel_bins), dtype=np.float32)
+    
+    predict_time = time.time()
+    
+    generate_func = generate_audio_features(audio_paths=audio_paths, 
+                                            workers=workers, 
+                                            batch_audios=batch_audios, 
+                                            queue_depth=max(prefetch, 1) * workers)
+    
+    for (n, (audio_path, feature)) in enumerate(generate_func):
+        
+        # Repeat short audios and cut long audios to seq_len frames
+        batch_x[n % batch_size] = repeat_feature(feature, seq_len)[0 : seq_len]
+        
+        if (n + 1) % batch_size == 0 or n + 1 == audios_num:
+            pointer = n - n % batch_size
+            probabilities[pointer : n + 1] = predict_batch(
+                model, batch_x[0 : n + 1 - pointer], mean, std, cuda)
+        
+    predictions = np.argmax(probabilities, axis=-1)
+    audio_names = [os.path.basename(audio_path) for audio_path in audio_paths]
+    
+    logging.info('Predict time: {:.3f} s, {:.1f} audios/s'.format(
+        time.time() - predict_time, 
+        audios_num / max(time.time() - predict_time, 1e-6)))
+    
+    create_folder(os.path.dirname(os.path.abspath(submission_path)))
+    write_evaluation_submission(submission_path, audio_names, predictions, 
+                                probabilities)
+
+
+def stream(args):
+    """Predict the posteriors of windows of seq_len frames every hop_frames 
+    frames of a long recording. The recording is read, resampled and 
+    transformed block by block and the frames shared by overlapping windows 
+    are calculated once, so the memory does not grow with its length. 
+    """
+    
+    # Arguments & parameters
+    checkpoint_path = args.checkpoint_path
+    scalar_path = args.scalar_path
+    audio_path = args.audio_path
+    output_path = args.output_path
+    hop_frames = args.hop_frames
+    block_size = args.block_size
+    cuda = args.cuda
+    
+    sample_rate = config.sample_rate
+    window_size = config.window_size
+    overlap = config.overlap
+    seq_len = config.seq_len
+    mel_bins = config.mel_bins
+    labels = config.labels
+    classes_num = len(labels)
+    
+    # Seconds between the starts of two frames
+    frame_time = (window_size - overlap) / float(sample_rate)
+    
+    # Load model
+    model = Model(classes_num)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(checkpoint['state_dict'])
+    
+    if cuda:
+        model.cuda()
+        
+    (mean, std) = get_checkpoint_scalar(checkpoint, scalar_path)
+    
+    feature_extractor = LogMelExtractor(sample_rate=sample_rate, 
+                                        window_size=window_size, 
+                                        overlap=overlap, 
+                                        mel_bins=mel_bins)
+                                        
+    audio_blocks = read_audio_blocks(audio_path, block_size=block_size, 
+                                     target_fs=sample_rate)
+                                     
+    feature_chunks = (feature_extractor.transform_stream(audio_block) 
+                      for audio_block in audio_blocks)
+                      
+    windows = generate_windows(feature_chunks, seq_len=seq_len, 
+                               hop_frames=hop_frames)
+    
+    create_folder(os.path.dirname(os.path.abspath(output_path)))
+    f = open(output_path, 'w')
+    f.write('\t'.join(['start', 'end', 'label'] + labels) + '\n')
+    
+    batch_x = np.zeros((batch_size, seq_len, mel_bins), dtype=np.float32)
+    starts = []
+    windows_num = 0
+    
+    stream_time = time.time()
+    
+    for (start, window) in itertools.chain(windows, [(None, None)]):
+        
+        if start is not None:
+            batch_x[len(starts)] = window
+            starts.append(start)
+            
+        # Predict a full mini-batch, or the last windows
+        if len(starts) == batch_size or (start is None and len(starts) > 0):
+            
+            probabilities = predict_batch(model, batch_x[0 : len(starts)], 
+                                          mean, std, cuda)
+                                          
+            for (n, window_start) in enumerate(starts):
+                f.write('{:.3f}\t{:.3f}\t{}'.format(
+                    window_start * frame_time, 
+                    (window_start + seq_len) * frame_time, 
+                    config.ix_to_lb[np.argmax(probabilities[n])]))
+                    
+                for probability in probabilities[n]:
+                    f.write('\t{:.6f}'.format(probability))
+                    
+                f.write('\n')
+                
+            windows_num += len(starts)
+            starts = []
+            
+    f.close()
+    
+    logging.info('Windows: {}, stream time: {:.3f} s'.format(
+        windows_num, time.time() - stream_time))
+    logging.info('Write result to {}'.format(output_path))
+
+
+def get_checkpoint_path(args):
+    """Checkpoint given by --checkpoint_path, else the checkpoint of 
+    --iteration in the models directory of the training run, the latest one 
+    if --iteration is not given. 
+    """
+    
+    if args.checkpoint_path is not None:
+        return args.checkpoint_path
+        
+    (_, _, _, models_dir) = get_train_paths(args)
+    
+    if args.iteration is None:
+        checkpoint_path = get_latest_checkpoint(models_dir)
+        
+        if checkpoint_path is None:
+            raise Exception('No checkpoint in {}!'.format(models_dir))
+            
+    else:
+        checkpoint_path = os.path.join(
+            models_dir, 'md_{}_iters.tar'.format(args.iteration))
+            
+    return checkpoint_path
+
+
+def serve(args):
+    """Serve the predictions of a checkpoint over http, see serving.py. 
+    Concurrent requests are grouped into mini-batches of at most batch_size. 
+    """
+    
+    # Arguments & parameters
+    scalar_path = args.scalar_path
+    host = args.host
+    port = args.port
+    max_latency = args.max_latency
+    cuda = args.cuda
+    
+    classes_num = len(config.labels)
+    
+    checkpoint_path = get_checkpoint_path(args)
+    
+    # Load model
+    model = Model(classes_num)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(checkpoint['state_dict'])
+    logging.info('Load checkpoint {}'.format(checkpoint_path))
+    
+    if cuda:
+        model.cuda()
+        
+    (mean, std) = get_checkpoint_scalar(checkpoint, scalar_path)
+    
+    # The adversarial prediction uses the attack length the checkpoint was 
+    # trained with unless it is given
+    adversary_config = checkpoint.get('adversary', {})
+    
+    epsilon_value = args.epsilon_value
+    alpha_value = args.alpha_value
+    
+    if epsilon_value is None:
+        epsilon_value = adversary_config.get('epsilon_value')
+        
+    if alpha_value is None:
+        alpha_value = adversary_config.get('alpha_value')
+        
+    adversary = FGSMAttack(model=model, epsilon=epsilon_value, 
+                           alpha=alpha_value)
+    
+    def predict_func(batch_x, adversarial):
+        
+        probabilities = predict_batch(model, batch_x, mean, std, cuda)
+        probabilities_adv = np.full_like(probabilities, np.nan)
+        
+        if np.any(adversarial):
+            
+            if epsilon_value is None or alpha_value is None:
+                raise Exception('Give --epsilon_value and --alpha_value for '
+                    'adversarial predictions!')
+                    
+            batch_x_adv = move_data_to_gpu(
+                scale(batch_x[adversarial], mean, std), cuda)
+            batch_x_adv = adversary.perturb(batch_x_adv, None)
+            
+            with torch.no_grad():
+                output_adv = model(batch_x_adv)
+                
+            probabilities_adv[adversarial] = torch.exp(output_adv).data.cpu().numpy()
+            
+        return probabilities, probabilities_adv
+        
+    run_server(predict_func=predict_func, 
+               host=host, 
+               port=port, 
+               max_batch_size=batch_size, 
+               max_latency=max_latency)
+
+
+def quantize(args):
+    """Quantize a checkpoint to INT8 with static post-training quantization 
+    calibrated on a slice of the training data, export it to TorchScript and 
+    compare its accuracy, adversarial accuracy and cpu throughput with the 
+    fp32 model on the validation data. 
+    
+    The exported graph takes unnormalized log mel features as the graphs of 
+    export(), see ExportModel, and is run by utils/graph_runner.py. 
+    """
+    
+    # Arguments & parameters
+    storage = args.storage
+    calibration_iteration = args.calibration_iteration
+    backend = args.backend
+    max_iteration = args.max_iteration
+    output_path = args.output_path
+    tolerance = args.tolerance
+    
+    labels = config.labels
+    classes_num = len(labels)
+    
+    devices = ['a']
+    
+    (hdf5_path, dev_train_csv, dev_validate_csv, _) = get_train_paths(args)
+    
+    checkpoint_path = get_checkpoint_path(args)
+    
+    if output_path is None:
+        output_path = os.path.splitext(checkpoint_path)[0] + '_int8.pt'
+    
+    # Load model, quantized models run on cpu
+    model = Model(classes_num)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(checkpoint['state_dict'])
+    model.eval()
+    
+    # Attack the checkpoint was trained with
+    for (key, value) in checkpoint.get('adversary', {}).items():
+        if getattr(args, key, None) is None:
+            setattr(args, key, value)
+    
+    adversary = get_adversary(args, model=model)
+    
+    generator = DataGenerator(hdf5_path=hdf5_path,
+                              batch_size=batch_size,
+                              dev_train_csv=dev_train_csv,
+                              dev_validate_csv=dev_validate_csv,
+                              storage=storage)
+                              
+    # Calibrate on a slice of the training data
+    generate_func = generator.generate_validate(
+        data_type='train', devices=devices, shuffle=True, 
+        max_iteration=calibration_iteration)
+        
+    calibration_batches = [move_data_to_gpu(batch_x, False) 
+                           for (batch_x, _, _) in generate_func]
+    
+    quantize_time = time.time()
+    quantized_model = quantize_model(model, calibration_batches, backend)
+    logging.info('Quantize time: {:.3f} s'.format(time.time() - quantize_time))
+    
+    # Export with the scalar, so that the graph takes unnormalized features
+    if 'mean' in checkpoint:
+        (mean, std) = get_checkpoint_scalar(checkpoint)
+    else:
+        (mean, std) = (generator.mean, generator.std)
+        
+    export_model = ExportModel(quantized_model, mean, std)
+    export_model.eval()
+    
+    example_input = torch.Tensor(
+        mean + std * np.random.RandomState(1).randn(2, config.seq_len, config.mel_bins))
+    
+    with torch.no_grad():
+        traced_model = torch.jit.trace(export_model, example_input)
+        
+    create_folder(os.path.dirname(output_path))
+    torch.jit.save(traced_model, output_path)
+    logging.info('Quantized model saved to {}'.format(output_path))
+    
+    check_export_parity(output_path, export_model, mean, std, tolerance)
+    
+    # Compare. Adversarial examples are generated on the fp32 model for both
+    for (name, evaluated_model) in [('fp32', model), ('int8', quantized_model)]:
+        
+        (va_acc, va_loss, va_acc_adv, va_loss_adv) = evaluate(
+            model=evaluated_model, 
+            model_adv=adversary, 
+            generator=generator, 
+            data_type='validate', 
+            devices=devices, 
+            max_iteration=max_iteration, 
+            cuda=False, 
+            source_model=model)
+            
+        # Throughput of the model alone, without the attack
+        forward_time = time.time()
+        
+        with torch.no_grad():
+            for batch_x in calibration_batches:
+                evaluated_model(batch_x)
+                
+        forward_time = time.time() - forward_time
+        
+        audios_num = sum(len(batch_x) for batch_x in calibration_batches)
+        
+        logging.info('{}: va_acc: {:.3f}, va_loss: {:.3f}, va_acc_adv: {:.3f}, '
+                     'va_loss_adv: {:.3f}, {:.1f} audios/s'.format(
+                         name, va_acc, va_loss, va_acc_adv, va_loss_adv, 
+                         audios_num / forward_time))
+
+
+def check_export_parity(export_path, export_model, mean, std, tolerance):
+    """Compare the log probabilities of an exported graph, run by 
+    GraphRunner, with the eager model on random features of several batch 
+    sizes. 
+    
+    Returns:
+      max_diff: float
+    """
+    
+    random_state = np.random.RandomState(0)
+    
+    load_time = time.time()
+    runner = GraphRunner(export_path)
+    load_time = time.time() - load_time
+    
+    max_diff = 0.
+    
+    for n in [1, 3, batch_size]:
+        x = mean + std * random_state.randn(n, config.seq_len, config.mel_bins)
+        x = x.astype(np.float32)
+        
+        with torch.no_grad():
+            output = export_model(torch.from_numpy(x)).numpy()
+            
+        max_diff = max(max_diff, np.max(np.abs(runner.predict(x) - output)))
+        
+    logging.info('{}: load time: {:.3f} s, max diff to eager model: {:.2e}'.format(
+        export_path, load_time, max_diff))
+        
+    if max_diff > tolerance:
+        raise Exception('Exported graph differs from the eager model by {}!'.format(
+            max_diff))
+            
+    return max_diff
+
+
+def export(args):
+    """Export a checkpoint with its scalar to a frozen TorchScript graph and, 
+    with --formats onnx, an ONNX graph of input (batch_size, seq_len, 
+    mel_bins) with a dynamic batch_size, see ExportModel, and check each 
+    graph against the eager model. The graphs are run by 
+    utils/graph_runner.py. 
+    """
+    
+    # Arguments & parameters
+    scalar_path = args.scalar_path
+    formats = args.formats
+    output_dir = args.output_dir
+    tolerance = args.tolerance
+    
+    seq_len = config.seq_len
+    mel_bins = config.mel_bins
+    classes_num = len(config.labels)
+    
+    # Check the ONNX dependencies before any graph is written
+    if 'onnx' in formats:
+        missing_packages = [package for package in ['onnx', 'onnxscript', 'onnxruntime'] 
+                            if importlib.util.find_spec(package) is None]
+                            
+        if len(missing_packages) > 0:
+            raise Exception('--formats onnx requires {}, not installed!'.format(
+                ', '.join(missing_packages)))
+    
+    checkpoint_path = get_checkpoint_path(args)
+    
+    if output_dir is None:
+        output_dir = os.path.dirname(checkpoint_path)
+        
+    create_folder(output_dir)
+    
+    export_name = os.path.splitext(os.path.basename(checkpoint_path))[0]
+    
+    # Load model
+    model = Model(classes_num)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(checkpoint['state_dict'])
+    
+    (mean, std) = get_checkpoint_scalar(checkpoint, scalar_path)
+    
+    export_model = ExportModel(model, mean, std)
+    export_model.eval()
+    
+    example_input = torch.Tensor(
+        mean + std * np.random.RandomState(1).randn(2, seq_len, mel_bins))
+    
+    for format in formats:
+        
+        if format == 'torchscript':
+            export_path = os.path.join(output_dir, '{}.pt'.format(export_name))
+            
+            with torch.no_grad():
+                traced_model = torch.jit.trace(export_model, example_input)
+                
+            torch.jit.save(torch.jit.freeze(traced_model), export_path)
+            
+        elif format == 'onnx':
+            export_path = os.path.join(output_dir, '{}.onnx'.format(export_name))
+            
+            torch.onnx.export(export_model, (example_input,), export_path, 
+                              input_names=['input'], 
+                              output_names=['output'], 
+                              dynamic_shapes=({0: torch.export.Dim('batch_size', min=1)},), 
+                              dynamo=True)
+                              
+        else:
+            raise Exception('Incorrect format!')
+            
+        logging.info('Exported {} to {}'.format(format, export_path))
+        
+        check_export_parity(export_path, export_model, mean, std, tolerance)
+
+
+def check_front_end_parity(args):
+    """Compare LogMelFrontEnd with LogMelExtractor.transform followed by 
+    repeat_feature, the features the models are trained on, on audios of 
+    several lengths: shorter than seq_len frames, exactly seq_len frames and 
+    longer. The scalar of the front end is checked with a random scalar. 
+    Raises an exception if the log mel features differ by more than 
+    --tolerance. 
+    """
+    
+    # Arguments & parameters
+    audio_dir = args.audio_dir
+    tolerance = args.tolerance
+    
+    sample_rate = config.sample_rate
+    window_size = config.window_size
+    overlap = config.overlap
+    seq_len = config.seq_len
+    mel_bins = config.mel_bins
+    hop_size = window_size - overlap
+    
+    random_state = np.random.RandomState(0)
+    
+    feature_extractor = LogMelExtractor(sample_rate=sample_rate, 
+                                        window_size=window_size, 
+                                        overlap=overlap, 
+                                        mel_bins=mel_bins)
+                                        
+    mean = random_state.randn(mel_bins)
+    std = random_state.uniform(0.5, 2., mel_bins)
+    
+    front_end = LogMelFrontEnd(sample_rate=sample_rate, 
+                               window_size=window_size, 
+                               overlap=overlap, 
+                               mel_bins=mel_bins, 
+                               seq_len=seq_len)
+                               
+    scaled_front_end = LogMelFrontEnd(sample_rate=sample_rate, 
+                                      window_size=window_size, 
+                                      overlap=overlap, 
+                                      mel_bins=mel_bins, 
+                                      seq_len=seq_len, 
+                                      mean=mean, 
+                                      std=std)
+    
+    # Random audios of 0.5 s, exactly seq_len frames, 3 s and 7.5 s
+    audio_lengths = [sample_rate // 2, 
+                     (seq_len - 1) * hop_size + window_size, 
+                     sample_rate * 3, 
+                     sample_rate * 15 // 2]
+                     
+    audios = [('random_{}'.format(audio_length), 
+               0.1 * random_state.randn(audio_length)) 
+              for audio_length in audio_lengths]
+              
+    if audio_dir is not None:
+        for audio_path in get_audio_paths(audio_dir=audio_dir):
+            (audio, _) = read_audio(audio_path, target_fs=sample_rate)
+            audios.append((os.path.basename(audio_path), audio))
+            
+    max_diff = 0.
+    
+    for (name, audio) in audios:
+        
+        feature = repeat_feature(feature_extractor.transform(audio), seq_len)
+        
+        with torch.no_grad():
+            x = torch.Tensor(audio[None, :])
+            output = front_end(x)[0].numpy()
+            scaled_output = scaled_front_end(x)[0].numpy()
+            
+        if output.shape != feature.shape:
+            raise Exception('{}: front end shape {} differs from {}!'.format(
+                name, output.shape, feature.shape))
+                
+        diff = max(np.max(np.abs(output - feature)), 
+                   np.max(np.abs(scaled_output - scale(feature, mean, std))))
+                   
+        logging.info('{}: frames: {}, max diff: {:.2e}'.format(
+            name, len(feature), diff))
+            
+        max_diff = max(max_diff, diff)
+        
+    if max_diff > tolerance:
+        raise Exception('Front end differs from LogMelExtractor by {}!'.format(
+            max_diff))
+            
+    logging.info('Front end matches LogMelExtractor, max diff: {:.2e}, '
+                 'tolerance: {:.0e}'.format(max_diff, tolerance))
+                 
+    return max_diff
+
 
 def inference_validation_data(args):
 
@@ -353,7 +1591,11 @@ def inference_validation_data(args):
     alpha_value = args.alpha_value
     filename = args.filename
     cuda = args.cuda
+    storage = args.storage
+    prefetch = args.prefetch
+    prenormalize = args.prenormalize
     validation = args.validation
+    output_dir = args.output_dir
 
     labels = config.labels
 
@@ -375,7 +1617,7 @@ def inference_validation_data(args):
         dev_validate_csv = os.path.join(dataset_dir, subdir, 'evaluation_setup', 'fold{}_devel.txt'.format(holdout_fold))
 
         model_path = os.path.join(workspace, 'models', subdir, filename,
-                                'holdout_fold={}'.format(holdout_fold), 'epsilon={}-alpha={}'.format(epsilon_value, alpha_value),
+                                'holdout_fold={}'.format(holdout_fold), get_run_name(args),
                                 'md_{}_iters.tar'.format(iteration))
     else:
 
@@ -384,14 +1626,14 @@ def inference_validation_data(args):
         dev_validate_csv = os.path.join(dataset_dir, subdir, 'evaluation_setup', 'fold{}_test.txt'.format(holdout_fold))
 
         model_path = os.path.join(workspace, 'models', subdir, filename,
-                                  'full_train', 'epsilon={}-alpha={}'.format(epsilon_value, alpha_value),
+                                  'full_train', get_run_name(args),
                                   'md_{}_iters.tar'.format(iteration))
 
     # Load model
     model = Model(classes_num)
     checkpoint = torch.load(model_path)
     model.load_state_dict(checkpoint['state_dict'])
-    adversary = FGSMAttack(epsilon=epsilon_value, alpha=alpha_value)
+    adversary = get_adversary(args)
 
     if cuda:
         model.cuda()
@@ -405,18 +1647,33 @@ def inference_validation_data(args):
         generator = DataGenerator(hdf5_path=hdf5_path,
                                   batch_size=batch_size,
                                   dev_train_csv=dev_train_csv,
-                                  dev_validate_csv=dev_validate_csv)
+                                  dev_validate_csv=dev_validate_csv,
+                                  storage=storage,
+                                  prenormalize=prenormalize)
 
         generate_func = generator.generate_validate(data_type='validate', 
                                                      devices=device, 
                                                      shuffle=False)
 
+        if prefetch > 0:
+            generate_func = Prefetcher(generate_func, queue_depth=prefetch, 
+                                       pin_memory=cuda)
+
+        if output_dir is not None:
+            device_output_dir = os.path.join(output_dir, device)
+            create_folder(device_output_dir)
+
+        else:
+            device_output_dir = None
+
         # Inference
         dict = forward(model=model,
-		       model_adv=adversary,
+                       model_adv=adversary,
                        generate_func=generate_func, 
                        cuda=cuda, 
-                       return_target=True)
+                       return_target=True, 
+                       audios_num=generator.get_audios_num('validate'), 
+                       output_dir=device_output_dir)
 
         outputs = dict['output']    # (audios_num, classes_num)
         targets = dict['target']    # (audios_num, classes_num)
@@ -428,14 +1685,13 @@ def inference_validation_data(args):
         classes_num = outputs.shape[-1]      
 
         # Evaluate
-        confusion_matrix = calculate_confusion_matrix(targets, predictions, classes_num)
-            
-        class_wise_accuracy = calculate_accuracy(targets, predictions, classes_num)
-
+        metrics = calculate_metrics(targets, predictions, classes_num)
+        confusion_matrix = metrics['confusion_matrix']
+        class_wise_accuracy = metrics['class_wise_accuracy']
 
-        confusion_matrix_adv = calculate_confusion_matrix(targets, predictions_adv, classes_num)
-            
-        class_wise_accuracy_adv = calculate_accuracy(targets, predictions_adv, classes_num)
+        metrics_adv = calculate_metrics(targets, predictions_adv, classes_num)
+        confusion_matrix_adv = metrics_adv['confusion_matrix']
+        class_wise_accuracy_adv = metrics_adv['class_wise_accuracy']
 
 
 
@@ -471,7 +1727,7 @@ if __name__ == '__main__':
 
     parser_train = subparsers.add_parser('train')
     parser_train.add_argument('--dataset_dir', type=str, required=True)
-    # parser_train.add_argument('--subdir', type=str, required=True)
+    parser_train.add_argument('--subdir', type=str, help='required with --validation')
     parser_train.add_argument('--workspace', type=str, required=True)
     parser_train.add_argument('--feature_type', type=str, default='logmel')
     parser_train.add_argument('--validation', action='store_true', default=False)
@@ -479,12 +1735,29 @@ if __name__ == '__main__':
     parser_train.add_argument('--epsilon_value', type=float)
     parser_train.add_argument('--alpha_value', type=float)
     parser_train.add_argument('--cuda', action='store_true', default=False)
+    parser_train.add_argument('--storage', type=str, default='memory', choices=['memory', 'hdf5', 'memmap'])
+    parser_train.add_argument('--prefetch', type=int, default=0)
+    parser_train.add_argument('--prenormalize', action='store_true', default=False)
+    parser_train.add_argument('--attack', type=str, default='fgsm', choices=['fgsm', 'pgd'])
+    parser_train.add_argument('--pgd_steps', type=int, default=10)
+    parser_train.add_argument('--pgd_restarts', type=int, default=1)
+    parser_train.add_argument('--random_start', action='store_true', default=False)
+    parser_train.add_argument('--fused_forward', action='store_true', default=False)
+    parser_train.add_argument('--fused_bn', type=str, default='shared', choices=['shared', 'split'])
+    parser_train.add_argument('--eval_interval', type=int, default=100)
+    parser_train.add_argument('--eval_train_subset', type=int, default=0)
+    parser_train.add_argument('--no_eval_train_attack', action='store_true', default=False)
+    parser_train.add_argument('--async_eval', action='store_true', default=False)
+    parser_train.add_argument('--adv_train', type=str, default='fgsm', choices=['fgsm', 'free'])
+    parser_train.add_argument('--replay_times', type=int, default=4)
+    parser_train.add_argument('--loss_weights', type=float, nargs=2, default=default_loss_weights)
+    parser_train.add_argument('--resume', action='store_true', default=False)
     parser_train.add_argument('--mini_data', action='store_true', default=False)
 
     
     parser_inference_validation_data = subparsers.add_parser('inference_validation_data')
     parser_inference_validation_data.add_argument('--dataset_dir', type=str, required=True)
-    # parser_inference_validation_data.add_argument('--subdir', type=str, required=True)
+    parser_inference_validation_data.add_argument('--subdir', type=str, required=True)
     parser_inference_validation_data.add_argument('--workspace', type=str, required=True)
     parser_inference_validation_data.add_argument('--feature_type', type=str, default='logmel')
     parser_inference_validation_data.add_argument('--validation', action='store_true', default=False)
@@ -493,7 +1766,133 @@ if __name__ == '__main__':
     parser_inference_validation_data.add_argument('--alpha_value', type=float)
     # parser_inference_validation_data.add_argument('--iteration', type=int, required=True)
     parser_inference_validation_data.add_argument('--cuda', action='store_true', default=False)
-
+    parser_inference_validation_data.add_argument('--storage', type=str, default='memory', choices=['memory', 'hdf5', 'memmap'])
+    parser_inference_validation_data.add_argument('--prefetch', type=int, default=0)
+    parser_inference_validation_data.add_argument('--prenormalize', action='store_true', default=False)
+    parser_inference_validation_data.add_argument('--attack', type=str, default='fgsm', choices=['fgsm', 'pgd'])
+    parser_inference_validation_data.add_argument('--pgd_steps', type=int, default=10)
+    parser_inference_validation_data.add_argument('--pgd_restarts', type=int, default=1)
+    parser_inference_validation_data.add_argument('--random_start', action='store_true', default=False)
+    parser_inference_validation_data.add_argument('--output_dir', type=str)
+    parser_inference_validation_data.add_argument('--loss_weights', type=float, nargs=2, default=default_loss_weights)
+
+
+    parser_sweep = subparsers.add_parser('sweep')
+    parser_sweep.add_argument('--dataset_dir', type=str, required=True)
+    parser_sweep.add_argument('--subdir', type=str, help='required with --validation')
+    parser_sweep.add_argument('--workspace', type=str, required=True)
+    parser_sweep.add_argument('--feature_type', type=str, default='logmel')
+    parser_sweep.add_argument('--validation', action='store_true', default=False)
+    parser_sweep.add_argument('--holdout_fold', type=int)
+    parser_sweep.add_argument('--cuda', action='store_true', default=False)
+    parser_sweep.add_argument('--storage', type=str, default='memory', choices=['memory', 'hdf5', 'memmap'])
+    parser_sweep.add_argument('--prefetch', type=int, default=0)
+    parser_sweep.add_argument('--prenormalize', action='store_true', default=False)
+    parser_sweep.add_argument('--attack', type=str, default='fgsm', choices=['fgsm', 'pgd'])
+    parser_sweep.add_argument('--pgd_steps', type=int, default=10)
+    parser_sweep.add_argument('--pgd_restarts', type=int, default=1)
+    parser_sweep.add_argument('--random_start', action='store_true', default=False)
+    parser_sweep.add_argument('--fused_forward', action='store_true', default=False)
+    parser_sweep.add_argument('--fused_bn', type=str, default='shared', choices=['shared', 'split'])
+    parser_sweep.add_argument('--eval_interval', type=int, default=100)
+    parser_sweep.add_argument('--eval_train_subset', type=int, default=0)
+    parser_sweep.add_argument('--no_eval_train_attack', action='store_true', default=False)
+    parser_sweep.add_argument('--adv_train', type=str, default='fgsm', choices=['fgsm', 'free'])
+    parser_sweep.add_argument('--replay_times', type=int, default=4)
+    parser_sweep.add_argument('--resume', action='store_true', default=False)
+    parser_sweep.add_argument('--mini_data', action='store_true', default=False)
+    parser_sweep.add_argument('--epsilon_values', type=float, nargs='+', required=True)
+    parser_sweep.add_argument('--alpha_values', type=float, nargs='+', required=True)
+    parser_sweep.add_argument('--loss_weights_values', type=str, nargs='+', default=[','.join(str(weight) for weight in default_loss_weights)])
+    parser_sweep.add_argument('--workers', type=int, default=1)
+
+
+    parser_predict = subparsers.add_parser('predict')
+    parser_predict.add_argument('--workspace', type=str, required=True)
+    parser_predict.add_argument('--checkpoint_path', type=str, required=True)
+    parser_predict.add_argument('--audio_dir', type=str)
+    parser_predict.add_argument('--audio_list', type=str)
+    parser_predict.add_argument('--scalar_path', type=str)
+    parser_predict.add_argument('--submission_path', type=str, required=True)
+    parser_predict.add_argument('--workers', type=int, default=1)
+    parser_predict.add_argument('--prefetch', type=int, default=2)
+    parser_predict.add_argument('--cuda', action='store_true', default=False)
+
+    parser_serve = subparsers.add_parser('serve')
+    parser_serve.add_argument('--dataset_dir', type=str)
+    parser_serve.add_argument('--subdir', type=str, help='required with --validation')
+    parser_serve.add_argument('--workspace', type=str, required=True)
+    parser_serve.add_argument('--feature_type', type=str, default='logmel')
+    parser_serve.add_argument('--validation', action='store_true', default=False)
+    parser_serve.add_argument('--holdout_fold', type=int)
+    parser_serve.add_argument('--epsilon_value', type=float)
+    parser_serve.add_argument('--alpha_value', type=float)
+    parser_serve.add_argument('--loss_weights', type=float, nargs=2, default=default_loss_weights)
+    parser_serve.add_argument('--iteration', type=int)
+    parser_serve.add_argument('--checkpoint_path', type=str)
+    parser_serve.add_argument('--scalar_path', type=str)
+    parser_serve.add_argument('--host', type=str, default='127.0.0.1')
+    parser_serve.add_argument('--port', type=int, default=8000)
+    parser_serve.add_argument('--max_latency', type=float, default=0.01)
+    parser_serve.add_argument('--mini_data', action='store_true', default=False)
+    parser_serve.add_argument('--cuda', action='store_true', default=False)
+
+    parser_stream = subparsers.add_parser('stream')
+    parser_stream.add_argument('--workspace', type=str, required=True)
+    parser_stream.add_argument('--checkpoint_path', type=str, required=True)
+    parser_stream.add_argument('--scalar_path', type=str)
+    parser_stream.add_argument('--audio_path', type=str, required=True)
+    parser_stream.add_argument('--output_path', type=str, required=True)
+    parser_stream.add_argument('--hop_frames', type=int, default=93)
+    parser_stream.add_argument('--block_size', type=int, default=65536)
+    parser_stream.add_argument('--cuda', action='store_true', default=False)
+
+    parser_quantize = subparsers.add_parser('quantize')
+    parser_quantize.add_argument('--dataset_dir', type=str)
+    parser_quantize.add_argument('--subdir', type=str, help='required with --validation')
+    parser_quantize.add_argument('--workspace', type=str, required=True)
+    parser_quantize.add_argument('--feature_type', type=str, default='logmel')
+    parser_quantize.add_argument('--validation', action='store_true', default=False)
+    parser_quantize.add_argument('--holdout_fold', type=int)
+    parser_quantize.add_argument('--epsilon_value', type=float)
+    parser_quantize.add_argument('--alpha_value', type=float)
+    parser_quantize.add_argument('--loss_weights', type=float, nargs=2, default=default_loss_weights)
+    parser_quantize.add_argument('--iteration', type=int)
+    parser_quantize.add_argument('--checkpoint_path', type=str)
+    parser_quantize.add_argument('--storage', type=str, default='memory', choices=['memory', 'hdf5', 'memmap'])
+    parser_quantize.add_argument('--attack', type=str, default='fgsm', choices=['fgsm', 'pgd'])
+    parser_quantize.add_argument('--pgd_steps', type=int, default=10)
+    parser_quantize.add_argument('--pgd_restarts', type=int, default=1)
+    parser_quantize.add_argument('--random_start', action='store_true', default=False)
+    parser_quantize.add_argument('--calibration_iteration', type=int, default=32)
+    parser_quantize.add_argument('--backend', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'])
+    parser_quantize.add_argument('--max_iteration', type=int)
+    parser_quantize.add_argument('--output_path', type=str)
+    parser_quantize.add_argument('--tolerance', type=float, default=1e-4)
+    parser_quantize.add_argument('--mini_data', action='store_true', default=False)
+
+    parser_export = subparsers.add_parser('export')
+    parser_export.add_argument('--dataset_dir', type=str)
+    parser_export.add_argument('--subdir', type=str, help='required with --validation')
+    parser_export.add_argument('--workspace', type=str, required=True)
+    parser_export.add_argument('--feature_type', type=str, default='logmel')
+    parser_export.add_argument('--validation', action='store_true', default=False)
+    parser_export.add_argument('--holdout_fold', type=int)
+    parser_export.add_argument('--epsilon_value', type=float)
+    parser_export.add_argument('--alpha_value', type=float)
+    parser_export.add_argument('--loss_weights', type=float, nargs=2, default=default_loss_weights)
+    parser_export.add_argument('--iteration', type=int)
+    parser_export.add_argument('--checkpoint_path', type=str)
+    parser_export.add_argument('--scalar_path', type=str)
+    parser_export.add_argument('--formats', type=str, nargs='+', default=['torchscript'], choices=['torchscript', 'onnx'])
+    parser_export.add_argument('--output_dir', type=str)
+    parser_export.add_argument('--tolerance', type=float, default=1e-4)
+    parser_export.add_argument('--mini_data', action='store_true', default=False)
+
+    parser_check_front_end = subparsers.add_parser('check_front_end')
+    parser_check_front_end.add_argument('--workspace', type=str, required=True)
+    parser_check_front_end.add_argument('--audio_dir', type=str)
+    parser_check_front_end.add_argument('--tolerance', type=float, default=1e-3)
 
     args = parser.parse_args()
 
@@ -507,9 +1906,30 @@ if __name__ == '__main__':
     if args.mode == 'train':
         train(args)
 
+    elif args.mode == 'sweep':
+        sweep(args)
+
     elif args.mode == 'inference_validation_data':
         inference_validation_data(args)
 
+    elif args.mode == 'predict':
+        predict(args)
+
+    elif args.mode == 'serve':
+        serve(args)
+
+    elif args.mode == 'stream':
+        stream(args)
+
+    elif args.mode == 'quantize':
+        quantize(args)
+
+    elif args.mode == 'export':
+        export(args)
+
+    elif args.mode == 'check_front_end':
+        check_front_end_parity(args)
+
     else:
         raise Exception('Error argument!')
 
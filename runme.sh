@@ -24,6 +24,10 @@ CONVLAYER=1
 epsilon_value=(0.02 0.04 0.06 0.08 0.1)
 alpha_value=(0.1)
 
+############ Sweep ############
+# Train all epsilon x alpha combinations, loading the data once
+#python $BACKEND/main_pytorch.py sweep --dataset_dir=$DATASET_DIR --subdir=$DEV_SUBTASK_A_DIR --workspace=$WORKSPACE --feature_type=$FEATURE --validation --holdout_fold=$HOLDOUT_FOLD --epsilon_values ${epsilon_value[@]} --alpha_values ${alpha_value[@]} --workers=4 --cuda
+
 for i in {0..4}
 do
 	for j in {0..0}
@@ -0,0 +1,112 @@
+import argparse
+import time
+import numpy as np
+
+from utilities import (calculate_confusion_matrix, calculate_accuracy,
+                       calculate_metrics)
+
+
+def loop_calculate_confusion_matrix(target, predict, classes_num):
+    """calculate_confusion_matrix before it was vectorized with bincount. """
+
+    confusion_matrix = np.zeros((classes_num, classes_num))
+    samples_num = len(target)
+
+    for n in range(samples_num):
+        confusion_matrix[target[n], predict[n]] += 1
+
+    return confusion_matrix
+
+
+def loop_calculate_accuracy(target, predict, classes_num):
+    """calculate_accuracy before it was vectorized with bincount, the
+    accuracy over all audios.
+    """
+
+    samples_num = len(target)
+
+    correctness = np.zeros(classes_num)
+    total = np.zeros(classes_num)
+
+    for n in range(samples_num):
+
+        total[target[n]] += 1
+
+        if target[n] == predict[n]:
+            correctness[target[n]] += 1
+
+    accuracy = sum(correctness) / sum(total)
+
+    return accuracy
+
+
+def get_time(func, repeats):
+    """Shortest time of repeats calls of func, in seconds. """
+
+    times = []
+
+    for _ in range(repeats):
+        bgn_time = time.time()
+        output = func()
+        times.append(time.time() - bgn_time)
+
+    return min(times), output
+
+
+def benchmark(args):
+    """Compare the loop and bincount implementations of the confusion
+    matrix and the accuracy, checking that their outputs are equal.
+    """
+
+    samples_num = args.samples_num
+    classes_num = args.classes_num
+    repeats = args.repeats
+
+    random_state = np.random.RandomState(0)
+    target = random_state.randint(classes_num, size=samples_num)
+    predict = random_state.randint(classes_num, size=samples_num)
+
+    print('Samples: {}, classes: {}'.format(samples_num, classes_num))
+
+    # Confusion matrix
+    (loop_time, loop_cm) = get_time(lambda: loop_calculate_confusion_matrix(
+        target, predict, classes_num), repeats)
+
+    (bincount_time, cm) = get_time(lambda: calculate_confusion_matrix(
+        target, predict, classes_num), repeats)
+
+    assert np.array_equal(loop_cm, cm)
+
+    print('confusion matrix: loop: {:.2f} ms, bincount: {:.2f} ms, {:.0f}x'.format(
+        loop_time * 1000, bincount_time * 1000, loop_time / bincount_time))
+
+    # Accuracy
+    (loop_time, loop_accuracy) = get_time(lambda: loop_calculate_accuracy(
+        target, predict, classes_num), repeats)
+
+    (bincount_time, accuracy) = get_time(lambda: calculate_accuracy(
+        target, predict, classes_num, average='micro'), repeats)
+
+    assert np.isclose(loop_accuracy, accuracy)
+
+    print('accuracy: loop: {:.2f} ms, bincount: {:.2f} ms, {:.0f}x'.format(
+        loop_time * 1000, bincount_time * 1000, loop_time / bincount_time))
+
+    # All metrics of an evaluation from one confusion matrix
+    (metrics_time, _) = get_time(lambda: calculate_metrics(
+        target, predict, classes_num), repeats)
+
+    print('calculate_metrics: {:.2f} ms'.format(metrics_time * 1000))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the loop and '
+        'bincount implementations of the confusion matrix and the accuracy.')
+    parser.add_argument('--samples_num', type=int, default=100000)
+    parser.add_argument('--classes_num', type=int, default=7)
+    parser.add_argument('--repeats', type=int, default=5)
+
+    args = parser.parse_args()
+
+    benchmark(args)
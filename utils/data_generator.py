@@ -1,19 +1,144 @@
+import os
 import numpy as np
 import h5py
 import csv
 import time
 import logging
+import threading
+import queue
+import torch
 from sklearn.preprocessing import OneHotEncoder
 
-from utilities import calculate_scalar, scale
+from utilities import StreamingScalar, scale
 import config
 import itertools
+import hashlib
+import tempfile
+
+
+def get_memmap_path(hdf5_path):
+    
+    return os.path.splitext(hdf5_path)[0] + '_feature.npy'
+
+
+def get_temp_path(path):
+    """Unique temporary file next to path, so that processes writing the 
+    same cache at the same time never write to the same file. 
+    """
+    
+    (fd, temp_path) = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), 
+        prefix=os.path.basename(path) + '.', suffix='.tmp')
+        
+    os.close(fd)
+    
+    return temp_path
+
+
+def publish_temp_path(temp_path, path):
+    """Atomically move a completely written temporary file to path. If 
+    another process has published path in the meantime, its file is kept. 
+    """
+    
+    try:
+        os.replace(temp_path, path)
+        
+    except OSError:
+        if not os.path.isfile(path):
+            raise
+            
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def export_feature_memmap(hdf5_path, memmap_path, chunk_size=1024):
+    """Export the feature dataset of an hdf5 file to a .npy file which can be 
+    memory-mapped. 
+    """
+    
+    temp_path = get_temp_path(memmap_path)
+    
+    try:
+        with h5py.File(hdf5_path, 'r') as hf:
+            feature = hf['feature']
+            
+            x = np.lib.format.open_memmap(temp_path, mode='w+', 
+                                          dtype=feature.dtype, 
+                                          shape=feature.shape)
+                                          
+            for n in range(0, len(feature), chunk_size):
+                x[n : n + chunk_size] = feature[n : n + chunk_size]
+                
+            x.flush()
+            del x
+            
+    except BaseException:
+        os.remove(temp_path)
+        raise
+        
+    publish_temp_path(temp_path, memmap_path)
+    
+    logging.info('Export features to {}'.format(memmap_path))
+
+
+def load_feature(hdf5_path, hf, storage):
+    """Load the feature dataset. 
+    
+    Args:
+      hdf5_path: str
+      hf: opened h5py file of hdf5_path
+      storage: 'memory' | 'hdf5' | 'memmap'
+      
+    Returns:
+      x: array, h5py dataset or memmap, (audios_num, seq_len, mel_bins)
+    """
+    
+    if storage == 'memory':
+        return hf['feature'][:]
+        
+    elif storage == 'hdf5':
+        return hf['feature']
+        
+    elif storage == 'memmap':
+        memmap_path = get_memmap_path(hdf5_path)
+        
+        if not os.path.isfile(memmap_path) or \
+            os.path.getmtime(memmap_path) < os.path.getmtime(hdf5_path):
+            export_feature_memmap(hdf5_path, memmap_path)
+            
+        return np.load(memmap_path, mmap_mode='r')
+        
+    else:
+        raise Exception('Invalid storage!')
+
+
+def get_scalar_path(hdf5_path, csv_file):
+    """Path of the cached scalar of the training data listed in csv_file. The 
+    key changes when the csv file or the hdf5 file changes. 
+    """
+    
+    key = hashlib.md5()
+    
+    if csv_file is None:
+        key.update(b'all')
+        
+    else:
+        with open(csv_file, 'rb') as f:
+            key.update(f.read())
+            
+    stat = os.stat(hdf5_path)
+    key.update('{}:{}'.format(stat.st_size, stat.st_mtime_ns).encode())
+    
+    return '{}_scalar_{}.npz'.format(os.path.splitext(hdf5_path)[0], 
+                                     key.hexdigest())
 
 
 class DataGenerator(object):
 
     def __init__(self, hdf5_path, batch_size, dev_train_csv=None,
-                 dev_validate_csv=None, seed=1234):
+                 dev_validate_csv=None, seed=1234, storage='memory', 
+                 prenormalize=False):
         """
         Inputs:
           hdf5_path: str
@@ -21,12 +146,19 @@ class DataGenerator(object):
           dev_train_csv: str | None, if None then use all data for training
           dev_validate_csv: str | None, if None then use all data for training
           seed: int, random seed
+          storage: 'memory' | 'hdf5' | 'memmap', 'memory' loads all features
+            to memory, 'hdf5' keeps the hdf5 file open and 'memmap' maps an 
+            exported .npy file, both read mini-batches on demand
+          prenormalize: bool, normalize the features once with the scalar of 
+            this fold instead of normalizing every mini-batch
         """
 
+        self.hdf5_path = hdf5_path
         self.batch_size = batch_size
+        self.storage = storage
 
-        self.random_state = np.random.RandomState(seed)
-        self.validate_random_state = np.random.RandomState(0)
+        self.seed = seed
+        self.reset_random_state()
         lb_to_ix = config.lb_to_ix
         ita_to_eng = config.ita_to_eng
         # Load data
@@ -34,11 +166,19 @@ class DataGenerator(object):
         hf = h5py.File(hdf5_path, 'r')
 
         self.audio_names = np.array([s.decode() for s in hf['filename'][:]])
-        self.x = hf['feature'][:]
+        self.x = load_feature(hdf5_path, hf, storage)
         self.emotion_labels = [s.decode() for s in hf['emotion_label'][:]]
         self.y = np.array([lb_to_ix[ita_to_eng[lb]] for lb in self.emotion_labels])
+        
+        self.audio_name_to_index = {audio_name: index for (index, audio_name) 
+                                    in enumerate(self.audio_names)}
 
-        hf.close()
+        if storage == 'hdf5':
+            self.hf = hf
+            
+        else:
+            hf.close()
+            
         logging.info('Loading data time: {:.3f} s'.format(
             time.time() - load_time))
 
@@ -73,47 +213,199 @@ class DataGenerator(object):
             len(self.validate_audio_indexes)))
                 
         # Calculate scalar
-        (self.mean, self.std) = calculate_scalar(
-            self.x[self.train_audio_indexes])
+        (self.mean, self.std) = self.load_scalar(hdf5_path, dev_train_csv)
+        
+        self.prenormalized = False
+        
+        if prenormalize:
+            self.prenormalize(hdf5_path)
+
+    def load_scalar(self, hdf5_path, csv_file, chunk_size=256):
+        """Load the scalar of the training data from its cache, or calculate 
+        it chunk by chunk and cache it next to the hdf5 file. 
+        
+        Args:
+          hdf5_path: str
+          csv_file: str | None, csv file of the training data
+          chunk_size: int, number of audios read at a time
+          
+        Returns:
+          mean: (freq_bins,)
+          std: (freq_bins,)
+        """
+        
+        scalar_path = get_scalar_path(hdf5_path, csv_file)
+        
+        if os.path.isfile(scalar_path):
+            data = np.load(scalar_path)
+            logging.info('Load scalar from {}'.format(scalar_path))
+            return data['mean'], data['std']
+            
+        scalar_time = time.time()
+        scalar = StreamingScalar()
+        audio_indexes = np.sort(self.train_audio_indexes)
+        
+        for n in range(0, len(audio_indexes), chunk_size):
+            scalar.update(self.get_x(audio_indexes[n : n + chunk_size]))
+            
+        (mean, std) = scalar.get_scalar()
+        
+        temp_path = get_temp_path(scalar_path)
+        
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, mean=mean, std=std)
+                
+        except BaseException:
+            os.remove(temp_path)
+            raise
+            
+        publish_temp_path(temp_path, scalar_path)
+        
+        logging.info('Calculate scalar time: {:.3f} s, saved to {}'.format(
+            time.time() - scalar_time, scalar_path))
+            
+        return mean, std
+
+    def prenormalize(self, hdf5_path, chunk_size=256):
+        """Normalize all features once with the scalar. In memory this is 
+        done in place, lazy storages are replaced by a normalized memmap 
+        cached next to the hdf5 file and tagged with the hash of the scalar. 
+        """
+        
+        normalize_time = time.time()
+        
+        if self.storage == 'memory':
+            self.x -= self.mean
+            self.x /= self.std
+            
+        else:
+            key = hashlib.md5(self.mean.tobytes() + self.std.tobytes())
+            
+            normalized_path = '{}_normalized_{}.npy'.format(
+                os.path.splitext(hdf5_path)[0], key.hexdigest())
+                
+            if not os.path.isfile(normalized_path) or \
+                os.path.getmtime(normalized_path) < os.path.getmtime(hdf5_path):
+                
+                temp_path = get_temp_path(normalized_path)
+                
+                try:
+                    x = np.lib.format.open_memmap(temp_path, mode='w+', 
+                                                  dtype=np.float32, 
+                                                  shape=self.x.shape)
+                                                  
+                    for n in range(0, len(x), chunk_size):
+                        x[n : n + chunk_size] = self.transform(
+                            self.x[n : n + chunk_size])
+                            
+                    x.flush()
+                    del x
+                    
+                except BaseException:
+                    os.remove(temp_path)
+                    raise
+                    
+                publish_temp_path(temp_path, normalized_path)
+                
+            if self.storage == 'hdf5':
+                self.hf.close()
+                
+            self.x = np.load(normalized_path, mmap_mode='r')
+            
+        self.prenormalized = True
+        
+        logging.info('Normalizing data time: {:.3f} s'.format(
+            time.time() - normalize_time))
+
+    def reset_random_state(self):
+        """Reset the shuffling of the generator to its initial state. """
+        
+        self.random_state = np.random.RandomState(self.seed)
+        self.validate_random_state = np.random.RandomState(0)
+
+    def reopen(self):
+        """Reopen the hdf5 file of the 'hdf5' storage. A forked process can 
+        not read through the h5py file of its parent, so it calls this first. 
+        """
+        
+        if self.storage == 'hdf5' and not self.prenormalized:
+            self.hf = h5py.File(self.hdf5_path, 'r')
+            self.x = self.hf['feature']
 
     def get_audio_indexes_from_csv(self, csv_file):
         """Calculate indexes from a csv file. 
         
         Args:
-          csv_file: str, path of csv file
+          csv_file: str | None, path of csv file, if None then use all data
         """
 
+        if csv_file is None:
+            return list(range(len(self.audio_names)))
+
         with open(csv_file, 'r') as f:
             reader = csv.reader(f, delimiter='\t')
             lis = list(reader)
 
         audio_indexes = []
+        missing_audio_names = []
 
         for li in lis:
             audio_name = li[0].split(',')[3]
 
-            if audio_name in self.audio_names:
-                audio_index = np.where(self.audio_names == audio_name)[0][0]
-                audio_indexes.append(audio_index)
+            if audio_name in self.audio_name_to_index:
+                audio_indexes.append(self.audio_name_to_index[audio_name])
+                
+            else:
+                missing_audio_names.append(audio_name)
+
+        if len(missing_audio_names) > 0:
+            logging.warning('{} audios of {} are not found in the features, '
+                'e.g. {}'.format(len(missing_audio_names), csv_file, 
+                missing_audio_names[0 : 5]))
 
         return audio_indexes
 
-    def generate_train(self):
+    def generate_train(self, state=None):
         """Generate mini-batch data for training. 
         
+        Args:
+          state: dict returned by get_train_state, continue from it instead 
+            of starting from a new shuffle
+        
         Returns:
           batch_x: (batch_size, seq_len, freq_bins)
           batch_y: (batch_size,)
         """
 
         batch_size = self.batch_size
-        audio_indexes = np.array(self.train_audio_indexes,dtype=int)
-        audios_num = len(audio_indexes)
 
-        self.random_state.shuffle(audio_indexes)
+        if state is None:
+            audio_indexes = np.array(self.train_audio_indexes,dtype=int)
+            self.random_state.shuffle(audio_indexes)
 
-        iteration = 0
-        pointer = 0
+            iteration = 0
+            pointer = 0
+
+        else:
+            audio_indexes = np.array(state['audio_indexes'], dtype=int)
+
+            (name, keys, position, has_gauss, cached_gaussian) = \
+                state['random_state']
+
+            self.random_state.set_state((name, np.array(keys, dtype=np.uint32), 
+                                         position, has_gauss, cached_gaussian))
+
+            iteration = state['iteration']
+            pointer = state['pointer']
+
+        audios_num = len(audio_indexes)
+
+        # Shuffle of every epoch and the iteration it starts at, to get the 
+        # state of any mini-batch handed out, also when mini-batches are 
+        # prefetched
+        self.train_epochs = [(iteration, pointer, audio_indexes.copy(), 
+                              self.random_state.get_state())]
 
         while True:
 
@@ -122,22 +414,51 @@ class DataGenerator(object):
                 pointer = 0
                 self.random_state.shuffle(audio_indexes)
 
+                self.train_epochs.append((iteration, pointer, 
+                                          audio_indexes.copy(), 
+                                          self.random_state.get_state()))
+
             # Get batch indexes
             batch_audio_indexes = audio_indexes[pointer: pointer + batch_size]
             pointer += batch_size
 
             iteration += 1
-            batch_x = self.x[batch_audio_indexes]
+            batch_x = self.get_x(batch_audio_indexes)
             batch_y = self.y[batch_audio_indexes]
 
             # Transform data
-            batch_x = self.transform(batch_x)
+            if not self.prenormalized:
+                batch_x = self.transform(batch_x)
 
             yield batch_x, batch_y
 
 
+    def get_train_state(self, iteration):
+        """State of generate_train before it yields the mini-batch of 
+        iteration, counted from 0. Continuing generate_train from this state 
+        yields the same mini-batches from this iteration on. 
+        
+        Returns:
+          state: dict, keys: 'iteration', 'pointer', 'audio_indexes', 
+            'random_state'. Values are python lists and numbers, so that the 
+            state can be saved in checkpoints
+        """
+
+        (epoch_iteration, epoch_pointer, audio_indexes, random_state) = \
+            [epoch for epoch in self.train_epochs if epoch[0] <= iteration][-1]
+
+        pointer = epoch_pointer + (iteration - epoch_iteration) * self.batch_size
+
+        (name, keys, position, has_gauss, cached_gaussian) = random_state
+
+        return {'iteration': iteration, 
+                'pointer': pointer, 
+                'audio_indexes': audio_indexes.tolist(), 
+                'random_state': (name, keys.tolist(), position, has_gauss, 
+                                 cached_gaussian)}
+
     def generate_validate(self, data_type, devices, shuffle, 
-                          max_iteration=None):
+                          max_iteration=None, audio_indexes=None):
         """Generate mini-batch data for evaluation. 
         
         Args:
@@ -145,6 +466,8 @@ class DataGenerator(object):
           devices: list of devices, e.g. ['a'] | ['a', 'b', 'c']
           max_iteration: int, maximum iteration for validation
           shuffle: bool
+          audio_indexes: list | array of int, subset of the data_type audios
+            to generate, None for all of them
           
         Returns:
           batch_x: (batch_size, seq_len, freq_bins)
@@ -154,7 +477,10 @@ class DataGenerator(object):
 
         batch_size = self.batch_size
 
-        if data_type == 'train':
+        if audio_indexes is not None:
+            pass
+
+        elif data_type == 'train':
             audio_indexes = self.train_audio_indexes
 
         elif data_type == 'validate':
@@ -163,6 +489,10 @@ class DataGenerator(object):
         else:
             raise Exception('Invalid data_type!')
             
+        # Shuffle a copy, so that evaluation does not change the order of the 
+        # training audios of later generate_train calls
+        audio_indexes = np.array(audio_indexes, dtype=int)
+            
         if shuffle:
             self.validate_random_state.shuffle(audio_indexes)
 
@@ -191,15 +521,87 @@ class DataGenerator(object):
 
             iteration += 1
 
-            batch_x = self.x[batch_audio_indexes]
+            batch_x = self.get_x(batch_audio_indexes)
             batch_y = self.y[batch_audio_indexes]
             batch_audio_names = self.audio_names[batch_audio_indexes]
 
             # Transform data
-            batch_x = self.transform(batch_x)
+            if not self.prenormalized:
+                batch_x = self.transform(batch_x)
 
             yield batch_x, batch_y, batch_audio_names
 
+    def get_audios_num(self, data_type, max_iteration=None, 
+                       audio_indexes=None):
+        """Number of audios yielded by generate_validate with the same 
+        arguments. 
+        """
+
+        if audio_indexes is not None:
+            audios_num = len(audio_indexes)
+
+        elif data_type == 'train':
+            audios_num = len(self.train_audio_indexes)
+
+        elif data_type == 'validate':
+            audios_num = len(self.validate_audio_indexes)
+
+        else:
+            raise Exception('Invalid data_type!')
+
+        if max_iteration is not None:
+            audios_num = min(audios_num, max_iteration * self.batch_size)
+
+        return audios_num
+
+    def get_subset_audio_indexes(self, data_type, audios_num, seed=1234):
+        """Random subset of the data_type audios. The same seed gives the 
+        same subset, so that evaluations on it are comparable. 
+        
+        Args:
+          data_type: 'train' | 'validate'
+          audios_num: int, number of audios in the subset
+          seed: int
+          
+        Returns:
+          audio_indexes: (audios_num,), sorted
+        """
+
+        if data_type == 'train':
+            audio_indexes = self.train_audio_indexes
+
+        elif data_type == 'validate':
+            audio_indexes = self.validate_audio_indexes
+
+        else:
+            raise Exception('Invalid data_type!')
+
+        audios_num = min(audios_num, len(audio_indexes))
+        random_state = np.random.RandomState(seed)
+
+        return np.sort(random_state.choice(audio_indexes, size=audios_num, 
+                                           replace=False))
+
+    def get_x(self, audio_indexes):
+        """Gather the features of audio indexes. Lazy storages are read in 
+        increasing index order, which h5py requires and which makes the reads 
+        as contiguous as possible. 
+        
+        Args:
+          audio_indexes: list | array of int
+          
+        Returns:
+          x: (len(audio_indexes), seq_len, freq_bins)
+        """
+        
+        if self.storage == 'memory':
+            return self.x[audio_indexes]
+            
+        (sorted_indexes, inverse_indexes) = np.unique(audio_indexes, 
+                                                      return_inverse=True)
+                                                      
+        return self.x[sorted_indexes][inverse_indexes]
+
     def transform(self, x):
         """Transform data. 
         
@@ -215,20 +617,23 @@ class DataGenerator(object):
     
 class TestDataGenerator(DataGenerator):
     
-    def __init__(self, dev_hdf5_path, test_hdf5_path, batch_size):
+    def __init__(self, dev_hdf5_path, test_hdf5_path, batch_size, 
+                 storage='memory'):
         """Data generator for test data. 
         
         Inputs:
           dev_hdf5_path: str
           test_hdf5_path: str
           batch_size: int
+          storage: 'memory' | 'hdf5' | 'memmap'
         """
         
         super(TestDataGenerator, self).__init__(
             hdf5_path=dev_hdf5_path, 
             batch_size=batch_size, 
             dev_train_csv=None,
-            dev_validate_csv=None)
+            dev_validate_csv=None, 
+            storage=storage)
             
         # Load test data
         load_time = time.time()
@@ -237,9 +642,13 @@ class TestDataGenerator(DataGenerator):
         self.test_audio_names = np.array(
             [s.decode() for s in hf['filename'][:]])
             
-        self.test_x = hf['feature'][:]
+        self.test_x = load_feature(test_hdf5_path, hf, storage)
         
-        hf.close()
+        if storage == 'hdf5':
+            self.test_hf = hf
+            
+        else:
+            hf.close()
         
         logging.info('Loading data time: {:.3f} s'.format(
             time.time() - load_time))
@@ -269,4 +678,134 @@ class TestDataGenerator(DataGenerator):
             # Transform data
             batch_x = self.transform(batch_x)
 
-            yield batch_x, batch_audio_names
\ No newline at end of file
+            yield batch_x, batch_audio_names
+
+
+def replay_generator(generate_func, replay_times, start_iteration=0, 
+                     first_iteration=0, first_replay=0):
+    """Yield each mini-batch of generate_func replay_times times in a row,
+    from the mini-batch start_iteration on. Used by free adversarial training.
+
+    Args:
+      generate_func: generate function
+      replay_times: int, number of times each mini-batch is yielded
+      start_iteration: int, mini-batches before it are yielded once
+      first_iteration: int, mini-batch index of the first mini-batch of 
+        generate_func, when continuing a generator
+      first_replay: int, replays of the first mini-batch already done
+    """
+
+    for (iteration, data) in enumerate(generate_func, first_iteration):
+
+        if iteration < start_iteration:
+            yield data
+
+        else:
+            for _ in range(first_replay, replay_times):
+                yield data
+
+            first_replay = 0
+
+
+class Prefetcher(object):
+    
+    def __init__(self, generate_func, queue_depth, pin_memory=False):
+        """Prepare the next mini-batches of a generate function on a 
+        background thread while the current mini-batch is used. batch_x is 
+        converted to a torch tensor, the other items are kept. 
+        
+        Inputs:
+          generate_func: generator of (batch_x, ...)
+          queue_depth: int, number of mini-batches prepared in advance
+          pin_memory: bool, copy batch_x into reused page-locked buffers for 
+            fast transfer to the GPU
+        """
+        
+        self.queue_depth = queue_depth
+        self.pin_memory = pin_memory
+        self.wait_time = 0.
+        
+        # A mini-batch is only overwritten after the consumer has requested 
+        # the next one, see run()
+        self.buffers = [None] * (queue_depth + 2)
+        
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.stop_event = threading.Event()
+        
+        self.thread = threading.Thread(target=self.run, args=(generate_func,))
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def to_tensor(self, batch_x, n):
+        
+        batch_x = torch.from_numpy(batch_x)
+        
+        if not self.pin_memory:
+            return batch_x
+            
+        k = n % len(self.buffers)
+        
+        if self.buffers[k] is None or \
+            self.buffers[k].shape[1:] != batch_x.shape[1:] or \
+            len(self.buffers[k]) < len(batch_x):
+            
+            self.buffers[k] = torch.empty(batch_x.shape, 
+                                          dtype=batch_x.dtype).pin_memory()
+            
+        buffer = self.buffers[k][0 : len(batch_x)]
+        buffer.copy_(batch_x)
+        
+        return buffer
+        
+    def put(self, item):
+        
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+                
+            except queue.Full:
+                pass
+                
+        return False
+        
+    def run(self, generate_func):
+        
+        try:
+            for (n, data) in enumerate(generate_func):
+                
+                item = (self.to_tensor(data[0], n),) + tuple(data[1:])
+                
+                if not self.put(('data', item)):
+                    return
+                    
+        except Exception as e:
+            self.put(('error', e))
+            return
+            
+        self.put(('end', None))
+        
+    def __iter__(self):
+        return self
+        
+    def __next__(self):
+        
+        wait_bgn_time = time.time()
+        (kind, item) = self.queue.get()
+        self.wait_time += time.time() - wait_bgn_time
+        
+        if kind == 'end':
+            raise StopIteration
+            
+        elif kind == 'error':
+            raise item
+            
+        return item
+        
+    def qsize(self):
+        
+        return self.queue.qsize()
+        
+    def close(self):
+        
+        self.stop_event.set()
@@ -7,10 +7,13 @@ import argparse
 import h5py
 import librosa
 from scipy import signal
+from scipy import fft
 import matplotlib.pyplot as plt
 import time
 import csv
 import random
+import multiprocessing
+import itertools
 
 from utilities import read_audio, create_folder
 import config
@@ -23,11 +26,16 @@ class LogMelExtractor():
         self.overlap = overlap
         self.ham_win = np.hamming(window_size)
         
+        # Scaling of the 'magnitude' mode of scipy's spectrogram
+        self.spectrum_scale = np.sqrt(1.0 / (self.ham_win * self.ham_win).sum())
+        
         self.melW = librosa.filters.mel(sr=sample_rate, 
                                         n_fft=window_size, 
                                         n_mels=mel_bins, 
                                         fmin=20., 
                                         fmax=sample_rate // 2).T
+        
+        self.reset_stream()
     
     def transform(self, audio):
     
@@ -50,6 +58,115 @@ class LogMelExtractor():
         x = x.astype(np.float32)
         
         return x
+        
+    def get_frames_num(self, audio_length):
+        
+        hop_size = self.window_size - self.overlap
+        
+        return max((audio_length - self.window_size) // hop_size + 1, 0)
+        
+    def transform_batch(self, audios):
+        """Transform a batch of audios at once. The output of each audio is 
+        identical to the output of transform(). 
+        
+        Args:
+          audios: list of 1d arrays
+          
+        Returns:
+          x: (batch_size, frames_num, mel_bins), frames_num is the number of 
+            frames of the longest audio. Frames after the end of a shorter 
+            audio are filled with log(1e-8), see get_frames_num. 
+        """
+        
+        window_size = self.window_size
+        hop_size = window_size - self.overlap
+        mel_bins = self.melW.shape[1]
+        
+        frames_nums = [self.get_frames_num(len(audio)) for audio in audios]
+        
+        # Frame all audios into one array through strided views, so that no 
+        # padded frames are calculated
+        frames = [np.lib.stride_tricks.sliding_window_view(
+            audio, window_size)[0 :: hop_size] 
+            for (audio, frames_num) in zip(audios, frames_nums) 
+            if frames_num > 0]
+            
+        frames = np.concatenate(
+            frames + [np.zeros((0, window_size))], axis=0)
+        '''(total_frames_num, window_size)'''
+        
+        x = self.frames_to_logmel(frames)
+        
+        output = np.full((len(audios), max(frames_nums + [0]), mel_bins), 
+                         np.log(1e-8), dtype=np.float32)
+                         
+        pointer = 0
+        
+        for (n, frames_num) in enumerate(frames_nums):
+            output[n, 0 : frames_num] = x[pointer : pointer + frames_num]
+            pointer += frames_num
+            
+        return output
+        
+    def frames_to_logmel(self, frames):
+        """Log mel of frames, which are overwritten. 
+        
+        Args:
+          frames: (frames_num, window_size), float64
+          
+        Returns:
+          x: (frames_num, mel_bins)
+        """
+        
+        frames *= self.ham_win
+        
+        x = fft.rfft(frames, n=self.window_size, overwrite_x=True)
+        x *= self.spectrum_scale
+        x = np.abs(x)
+        
+        x = np.dot(x, self.melW)
+        x += 1e-8
+        np.log(x, out=x)
+        x = x.astype(np.float32)
+        
+        return x
+        
+    def reset_stream(self):
+        """Start a new stream of transform_stream. """
+        
+        self.stream_buffer = np.zeros(0)
+        
+    def transform_stream(self, audio):
+        """Transform an audio given chunk by chunk. The samples after the 
+        last frame of a chunk are kept in an overlap buffer, shorter than 
+        window_size, and start the frames of the next chunk, so that the 
+        frames of all chunks together are identical to the frames of 
+        transform() on the whole audio. 
+        
+        Args:
+          audio: 1d array, next chunk of the audio
+          
+        Returns:
+          x: (frames_num, mel_bins), frames completed by this chunk
+        """
+        
+        window_size = self.window_size
+        hop_size = window_size - self.overlap
+        
+        audio = np.concatenate((self.stream_buffer, audio))
+        frames_num = self.get_frames_num(len(audio))
+        
+        if frames_num > 0:
+            frames = np.lib.stride_tricks.sliding_window_view(
+                audio, window_size)[0 : frames_num * hop_size : hop_size]
+        else:
+            frames = np.zeros((0, window_size))
+            
+        x = self.frames_to_logmel(np.array(frames, dtype=np.float64))
+        
+        self.stream_buffer = audio[frames_num * hop_size :].copy()
+        
+        return x
 
 
 def calculate_logmel(audio_path, sample_rate, feature_extractor):
@@ -66,6 +183,232 @@ def calculate_logmel(audio_path, sample_rate, feature_extractor):
     return feature
 
 
+def calculate_logmel_batch(audio_paths, sample_rate, feature_extractor):
+    """Calculate the log mel features of several audios with one call of 
+    transform_batch. 
+    
+    Returns:
+      features: list of (frames_num, mel_bins)
+    """
+    
+    audios = [read_audio(audio_path, target_fs=sample_rate)[0] 
+              for audio_path in audio_paths]
+              
+    x = feature_extractor.transform_batch(audios)
+    
+    features = [x[n, 0 : feature_extractor.get_frames_num(len(audio))] 
+                for (n, audio) in enumerate(audios)]
+                
+    return features
+
+
+def repeat_feature(feature, seq_len):
+    """Repeat a feature shorter than seq_len along time up to seq_len frames.
+
+    Args:
+      feature: (frames_num, mel_bins)
+      seq_len: int
+
+    Returns:
+      feature: (seq_len, mel_bins) if frames_num < seq_len
+    """
+
+    if len(feature) < seq_len:
+        stack_n1 = seq_len // len(feature) - 1
+        stack_n2 = seq_len % len(feature)
+        feature_temp = feature
+        for n1 in range(0, stack_n1):
+            feature = np.vstack((feature, feature_temp))
+        feature = np.vstack((feature, feature_temp[0:stack_n2]))
+
+    return feature
+
+
+def generate_windows(feature_chunks, seq_len, hop_frames):
+    """Cut a feature given chunk by chunk into windows of seq_len frames 
+    starting every hop_frames frames. Only the frames of windows which are 
+    not complete yet are kept, so the memory does not grow with the length 
+    of the feature. A feature shorter than seq_len gives one window repeated 
+    up to seq_len frames. 
+    
+    Args:
+      feature_chunks: iterable of (frames_num, mel_bins)
+      seq_len: int
+      hop_frames: int
+      
+    Returns:
+      generator of (start, window), start: int, first frame of the window, 
+        window: (seq_len, mel_bins), only valid until the next window
+    """
+    
+    frames = None
+    offset = 0  # Frame of frames[0]
+    start = 0
+    
+    for feature_chunk in feature_chunks:
+        
+        if frames is None:
+            frames = feature_chunk
+        else:
+            frames = np.concatenate((frames, feature_chunk), axis=0)
+            
+        while start + seq_len <= offset + len(frames):
+            yield start, frames[start - offset : start - offset + seq_len]
+            start += hop_frames
+            
+        # Frames before the next window are not used any more
+        drop_num = min(start - offset, len(frames))
+        frames = frames[drop_num :]
+        offset += drop_num
+        
+    if start == 0 and frames is not None and len(frames) > 0:
+        yield 0, repeat_feature(frames, seq_len)
+        
+
+# Feature extractor of a worker process, built once by init_worker
+worker_feature_extractor = None
+worker_sample_rate = None
+
+
+def init_worker(sample_rate, window_size, overlap, mel_bins):
+    """Build the feature extractor of a worker process, so that the mel
+    filterbank is calculated once per worker instead of once per audio.
+    """
+
+    global worker_feature_extractor, worker_sample_rate
+
+    worker_feature_extractor = LogMelExtractor(sample_rate=sample_rate,
+                                               window_size=window_size,
+                                               overlap=overlap,
+                                               mel_bins=mel_bins)
+    worker_sample_rate = sample_rate
+
+
+def calculate_worker_logmel(audio_paths):
+
+    return calculate_logmel_batch(audio_paths=audio_paths,
+                                  sample_rate=worker_sample_rate,
+                                  feature_extractor=worker_feature_extractor)
+
+
+def get_extraction_parameters():
+    """Parameters in config.py which change the extracted features. """
+
+    return {'sample_rate': config.sample_rate,
+            'window_size': config.window_size,
+            'overlap': config.overlap,
+            'seq_len': config.seq_len,
+            'mel_bins': config.mel_bins}
+
+
+def get_fingerprint(audio_path):
+    """Fingerprint of an audio file, used to find out whether the audio has
+    changed since its feature was extracted.
+    """
+
+    stat = os.stat(audio_path)
+
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def read_extracted_audios(hf, parameters):
+    """Read the audios already extracted in an hdf5 file.
+
+    Args:
+      hf: h5py file
+      parameters: dict, extraction parameters of the current config
+
+    Returns:
+      None if the file was extracted with other parameters, else
+      (audio_names, emotion_labels, fingerprints), one entry per row of
+      the feature dataset
+    """
+
+    for key in ['feature', 'filename', 'emotion_label', 'fingerprint']:
+        if key not in hf:
+            return None
+
+    for (key, value) in parameters.items():
+        if key not in hf.attrs or hf.attrs[key] != value:
+            return None
+
+    audio_names = [s.decode() for s in hf['filename'][:]]
+    emotion_labels = [s.decode() for s in hf['emotion_label'][:]]
+    fingerprints = [s.decode() for s in hf['fingerprint'][:]]
+
+    return audio_names, emotion_labels, fingerprints
+
+
+def write_meta(hf, audio_names, emotion_labels):
+
+    for key in ['filename', 'emotion_label']:
+        if key in hf:
+            del hf[key]
+
+    hf.create_dataset(name='filename',
+                      data=[s.encode() for s in audio_names],
+                      dtype='S50')
+
+    hf.create_dataset(name='emotion_label',
+                      data=[s.encode() for s in emotion_labels],
+                      dtype='S20')
+
+
+class FeatureWriter(object):
+    def __init__(self, hf, buffer_size):
+        """Buffer features and write them to the pre-allocated feature dataset
+        in blocks, instead of resizing and writing the dataset once per audio.
+
+        Args:
+          hf: h5py file with 'feature' and 'fingerprint' datasets
+          buffer_size: int, number of features written in one block
+        """
+
+        self.hf = hf
+        self.buffer = np.zeros((buffer_size,) + hf['feature'].shape[1:],
+                               dtype=hf['feature'].dtype)
+
+        self.rows = []
+        self.fingerprints = []
+
+    def append(self, row, feature, fingerprint):
+
+        self.buffer[len(self.rows)] = feature
+        self.rows.append(row)
+        self.fingerprints.append(fingerprint.encode())
+
+        if len(self.rows) == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+
+        if len(self.rows) == 0:
+            return
+
+        rows = np.array(self.rows)
+        features = self.buffer[0 : len(rows)]
+        fingerprints = np.array(self.fingerprints)
+
+        if np.all(np.diff(rows) == 1):
+            indexes = slice(rows[0], rows[-1] + 1)
+
+        else:
+            # h5py only writes to increasing indexes
+            order = np.argsort(rows)
+            indexes = list(rows[order])
+            features = features[order]
+            fingerprints = fingerprints[order]
+
+        # Fingerprints are written after the features, so an interrupted
+        # extraction never marks an unwritten feature as extracted
+        self.hf['feature'][indexes] = features
+        self.hf['fingerprint'][indexes] = fingerprints
+        self.hf.flush()
+
+        self.rows = []
+        self.fingerprints = []
+
+
 def read_development_meta(meta_csv):
     
     df = pd.read_csv(meta_csv)
@@ -93,12 +436,17 @@ def calculate_features(args):
     data_type = args.data_type
     workspace = args.workspace
     mini_data = args.mini_data
+    workers = args.workers
+    write_buffer = args.write_buffer
+    incremental = args.incremental
 
     sample_rate = config.sample_rate
     window_size = config.window_size
     overlap = config.overlap
     seq_len = config.seq_len
     mel_bins = config.mel_bins
+    chunk_audios = 8
+    batch_audios = 4
     
     # Paths
     audio_dir = dataset_dir
@@ -111,70 +459,140 @@ def calculate_features(args):
 
     create_folder(os.path.dirname(hdf5_path))
     
-    # Feature extractor
-    feature_extractor = LogMelExtractor(sample_rate=sample_rate, 
-                                        window_size=window_size, 
-                                        overlap=overlap, 
-                                        mel_bins=mel_bins)
-
     # Read meta csv
     if data_type == 'development':
         [audio_names, emotion_labels] = read_development_meta(meta_csv)
         
     print('Number of audios: {}'.format(len(audio_names)))
     
-    # Create hdf5 file
-    hf = h5py.File(hdf5_path, 'w')
-    
-    hf.create_dataset(
-        name='feature', 
-        shape=(0, seq_len, mel_bins), 
-        maxshape=(None, seq_len, mel_bins), 
-        dtype=np.float32)
-    
+    audio_paths = [os.path.join(audio_dir, audio_name)
+                   for audio_name in audio_names]
+
+    parameters = get_extraction_parameters()
+    fingerprints = [get_fingerprint(audio_path) for audio_path in audio_paths]
+
+    # Audios already in the hdf5 file
+    extracted = None
+
+    if incremental and os.path.isfile(hdf5_path):
+        hf = h5py.File(hdf5_path, 'a')
+        extracted = read_extracted_audios(hf, parameters)
+
+        if extracted is None:
+            hf.close()
+            print('Extraction parameters changed, extract all audios. ')
+
+    if extracted is None:
+
+        # Create hdf5 file
+        hf = h5py.File(hdf5_path, 'w')
+
+        # The number of audios is known, so the feature dataset is allocated
+        # once. Chunks hold a few consecutive audios, which suits both the
+        # block writes below and the mini-batch reads of the data generator.
+        hf.create_dataset(
+            name='feature',
+            shape=(len(audio_names), seq_len, mel_bins),
+            maxshape=(None, seq_len, mel_bins),
+            chunks=(min(chunk_audios, max(len(audio_names), 1)), seq_len, mel_bins),
+            dtype=np.float32)
+
+        # An empty fingerprint marks a row which is not extracted yet
+        hf.create_dataset(
+            name='fingerprint',
+            shape=(len(audio_names),),
+            maxshape=(None,),
+            dtype='S40')
+
+        for (key, value) in parameters.items():
+            hf.attrs[key] = value
+
+        row_names = list(audio_names)
+        row_labels = list(emotion_labels)
+        rows = list(range(len(audio_names)))
+        extract_indexes = list(range(len(audio_names)))
+
+    else:
+
+        # Extract new and changed audios only. Changed audios are rewritten
+        # in their rows, new audios are appended.
+        (row_names, row_labels, row_fingerprints) = extracted
+        name_to_row = {name: row for (row, name) in enumerate(row_names)}
+
+        rows = []
+        extract_indexes = []
+
+        for (n, audio_name) in enumerate(audio_names):
+
+            if audio_name in name_to_row:
+                row = name_to_row[audio_name]
+                row_labels[row] = emotion_labels[n]
+
+                if row_fingerprints[row] != fingerprints[n]:
+                    extract_indexes.append(n)
+
+            else:
+                row = len(row_names)
+                row_names.append(audio_name)
+                row_labels.append(emotion_labels[n])
+                extract_indexes.append(n)
+
+            rows.append(row)
+
+        hf['feature'].resize(len(row_names), axis=0)
+        hf['fingerprint'].resize(len(row_names), axis=0)
+
+    print('Number of audios to extract: {}'.format(len(extract_indexes)))
+
+    # Write meta info to hdf5
+    write_meta(hf, row_names, row_labels)
+    hf.flush()
+
+    writer = FeatureWriter(hf, buffer_size=write_buffer)
+
     calculate_time = time.time()
 
-    for (n, audio_name) in enumerate(audio_names):
-        
-        # print(n, audio_name)
-        
-        # Calculate feature
-        audio_path = os.path.join(audio_dir, audio_name)
-        
-        # Extract feature
-        feature = calculate_logmel(audio_path=audio_path, 
-                                    sample_rate=sample_rate, 
-                                    feature_extractor=feature_extractor)
-        '''(seq_len, mel_bins)'''
-        
-        # print(feature.shape)
+    # Extract features in a process pool. imap returns the features in the
+    # order of the meta csv, so a single writer fills the hdf5 file.
+    extract_paths = [audio_paths[n] for n in extract_indexes]
+    
+    # Audios are decoded and transformed in small batches
+    path_batches = [extract_paths[n : n + batch_audios] 
+                    for n in range(0, len(extract_paths), batch_audios)]
+
+    if workers > 1:
+        pool = multiprocessing.Pool(
+            processes=workers,
+            initializer=init_worker,
+            initargs=(sample_rate, window_size, overlap, mel_bins))
+
+        feature_batches = pool.imap(calculate_worker_logmel, path_batches)
+
+    else:
+        pool = None
+        init_worker(sample_rate, window_size, overlap, mel_bins)
+        feature_batches = map(calculate_worker_logmel, path_batches)
+
+    features = itertools.chain.from_iterable(feature_batches)
+
+    for (n, feature) in zip(extract_indexes, features):
 
         # repeat
-        if len(feature) < seq_len:
-            stack_n1 = seq_len // len(feature) - 1
-            stack_n2 = seq_len % len(feature)
-            feature_temp = feature
-            for n1 in range(0, stack_n1):
-                feature = np.vstack((feature, feature_temp))
-            feature = np.vstack((feature, feature_temp[0:stack_n2]))
+        feature = repeat_feature(feature, seq_len)
+        '''(seq_len, mel_bins)'''
 
-        hf['feature'].resize((n + 1, seq_len, mel_bins))
-        hf['feature'][n] = feature
+        writer.append(rows[n], feature, fingerprints[n])
 
         # Plot log Mel for debug
         if False:
             plt.matshow(feature.T, origin='lower', aspect='auto', cmap='jet')
             plt.show()
-        
-    # Write meta info to hdf5
-    hf.create_dataset(name='filename', 
-                      data=[s.encode() for s in audio_names], 
-                      dtype='S50')
-    
 
-    hf.create_dataset(name='emotion_label',
-                      data=[s.encode() for s in emotion_labels],
-                      dtype='S20')
+    writer.flush()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     hf.close()
     
@@ -197,6 +615,9 @@ if __name__ == '__main__':
     parser.add_argument('--workspace', type=str, default=WORKSPACE)
     parser.add_argument('--data_type', type=str, default='development')
     parser.add_argument('--mini_data', action='store_true', default=False)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--write_buffer', type=int, default=64)
+    parser.add_argument('--incremental', action='store_true', default=False)
 
     args = parser.parse_args()
 
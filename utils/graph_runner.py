@@ -0,0 +1,100 @@
+import os
+import time
+import argparse
+import numpy as np
+
+
+class GraphRunner(object):
+    def __init__(self, model_path, threads=None):
+        """Run a model exported by the export mode of main_pytorch.py, a
+        frozen TorchScript (.pt) or an ONNX (.onnx) graph. Only torch or
+        onnxruntime is imported, not the model classes or the training code,
+        so a process starts faster. The graph normalizes its input itself.
+
+        Args:
+          model_path: str
+          threads: int | None, number of intra-op threads, None for the
+            default of the runtime
+        """
+
+        if os.path.splitext(model_path)[1] == '.onnx':
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = \
+                onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+            if threads is not None:
+                options.intra_op_num_threads = threads
+
+            self.session = onnxruntime.InferenceSession(
+                model_path, options, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+            self.model = None
+
+        else:
+            import torch
+
+            if threads is not None:
+                torch.set_num_threads(threads)
+
+            self.torch = torch
+            self.model = torch.jit.load(model_path, map_location='cpu')
+            self.model.eval()
+            self.session = None
+
+    def predict(self, x):
+        """
+        Inputs:
+          x: (batch_size, seq_len, mel_bins), unnormalized log mel
+
+        Outputs:
+          (batch_size, classes_num), log probabilities
+        """
+
+        x = np.ascontiguousarray(x, dtype=np.float32)
+
+        if self.session is not None:
+            return self.session.run(None, {self.input_name: x})[0]
+
+        else:
+            with self.torch.no_grad():
+                return self.model(self.torch.from_numpy(x)).numpy()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Predict the probabilities '
+        'of log mel features with an exported model.')
+    parser.add_argument('--model_path', type=str, required=True)
+    parser.add_argument('--feature_path', type=str, required=True,
+                        help='.npy of (audios_num, seq_len, mel_bins)')
+    parser.add_argument('--output_path', type=str, required=True)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--threads', type=int)
+
+    args = parser.parse_args()
+
+    load_time = time.time()
+    runner = GraphRunner(args.model_path, threads=args.threads)
+    load_time = time.time() - load_time
+
+    x = np.load(args.feature_path, mmap_mode='r')
+    probabilities = np.zeros((len(x), 0), dtype=np.float32)
+
+    predict_time = time.time()
+
+    for n in range(0, len(x), args.batch_size):
+        output = np.exp(runner.predict(x[n : n + args.batch_size]))
+
+        if n == 0:
+            probabilities = np.zeros((len(x), output.shape[-1]),
+                                     dtype=np.float32)
+
+        probabilities[n : n + len(output)] = output
+
+    np.save(args.output_path, probabilities)
+
+    print('Load time: {:.3f} s, predict time: {:.3f} s'.format(
+        load_time, time.time() - predict_time))
+    print('Write probabilities to {}'.format(args.output_path))
@@ -0,0 +1,306 @@
+import io
+import json
+import base64
+import time
+import logging
+import threading
+import queue
+import collections
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+from utilities import read_audio
+from features import LogMelExtractor, repeat_feature
+import config
+
+
+class ServerMetrics(object):
+    def __init__(self, window=10000):
+        """Throughput and latency of the latest window requests.
+
+        Args:
+          window: int, number of latest requests the statistics are
+            calculated on
+        """
+
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests_num = 0
+        self.batches_num = 0
+
+        self.latencies = collections.deque(maxlen=window)
+        self.finish_times = collections.deque(maxlen=window)
+
+    def add_batch(self, latencies, finish_time):
+
+        with self.lock:
+            self.requests_num += len(latencies)
+            self.batches_num += 1
+            self.latencies.extend(latencies)
+            self.finish_times.extend([finish_time] * len(latencies))
+
+    def summary(self):
+
+        with self.lock:
+            latencies = np.array(self.latencies)
+            finish_times = np.array(self.finish_times)
+            requests_num = self.requests_num
+            batches_num = self.batches_num
+
+        if len(finish_times) > 1 and finish_times[-1] > finish_times[0]:
+            throughput = (len(finish_times) - 1) / (finish_times[-1] - finish_times[0])
+        else:
+            throughput = 0.
+
+        if len(latencies) > 0:
+            (p50, p99) = np.percentile(latencies, [50, 99]) * 1000
+        else:
+            (p50, p99) = (0., 0.)
+
+        return {'uptime': time.time() - self.start_time,
+                'requests_num': requests_num,
+                'batches_num': batches_num,
+                'mean_batch_size': requests_num / max(batches_num, 1),
+                'throughput': throughput,
+                'latency_p50_ms': p50,
+                'latency_p99_ms': p99}
+
+
+class MicroBatcher(object):
+    def __init__(self, predict_func, max_batch_size, max_latency, metrics):
+        """Group concurrent requests into mini-batches before calling the
+        model. A mini-batch is run once it has max_batch_size requests, or
+        max_latency seconds after its first request arrived. The model is
+        only called from the thread of the batcher.
+
+        Args:
+          predict_func: function, (batch_x, adversarial) -> (probabilities,
+            probabilities_adv). batch_x: (batch_size, seq_len, mel_bins),
+            adversarial: bool array, (batch_size,), probabilities and
+            probabilities_adv: (batch_size, classes_num), rows of
+            probabilities_adv are only used where adversarial is True
+          max_batch_size: int
+          max_latency: float, seconds
+          metrics: ServerMetrics
+        """
+
+        self.predict_func = predict_func
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.metrics = metrics
+
+        self.queue = queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def predict(self, feature, adversarial=False):
+        """Blocks until the mini-batch of the feature has been predicted.
+
+        Returns:
+          probabilities: (classes_num,)
+          probabilities_adv: (classes_num,) | None
+        """
+
+        request = {'feature': feature,
+                   'adversarial': adversarial,
+                   'arrival_time': time.time(),
+                   'event': threading.Event()}
+
+        self.queue.put(request)
+        request['event'].wait()
+
+        if 'error' in request:
+            raise request['error']
+
+        return request['probabilities'], request['probabilities_adv']
+
+    def get_batch(self):
+
+        requests = [self.queue.get()]
+        deadline = requests[0]['arrival_time'] + self.max_latency
+
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.time()
+
+            try:
+                if timeout > 0:
+                    requests.append(self.queue.get(timeout=timeout))
+                else:
+                    requests.append(self.queue.get_nowait())
+
+            except queue.Empty:
+                break
+
+        return requests
+
+    def run(self):
+
+        while True:
+            requests = self.get_batch()
+
+            batch_x = np.array([request['feature'] for request in requests])
+            adversarial = np.array([request['adversarial'] for request in requests])
+
+            try:
+                (probabilities, probabilities_adv) = self.predict_func(
+                    batch_x, adversarial)
+
+                for (n, request) in enumerate(requests):
+                    request['probabilities'] = probabilities[n]
+
+                    if request['adversarial']:
+                        request['probabilities_adv'] = probabilities_adv[n]
+                    else:
+                        request['probabilities_adv'] = None
+
+            except Exception as e:
+                logging.exception('Prediction of a mini-batch failed')
+
+                for request in requests:
+                    request['error'] = e
+
+            finish_time = time.time()
+
+            self.metrics.add_batch(
+                [finish_time - request['arrival_time'] for request in requests],
+                finish_time)
+
+            for request in requests:
+                request['event'].set()
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """POST /predict takes a wav file as body, or a json object with a base64
+    encoded wav file 'audio' or an unnormalized log mel feature 'logmel' of
+    (frames_num, mel_bins). The adversarial prediction is returned with the
+    query ?adversarial=1 or the json field 'adversarial': true.
+
+    GET /metrics returns the throughput and latency of the server.
+    """
+
+    def do_GET(self):
+
+        if urlparse(self.path).path == '/metrics':
+            self.send_json(200, self.server.metrics.summary())
+
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+
+        url = urlparse(self.path)
+
+        if url.path != '/predict':
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        adversarial = parse_qs(url.query).get('adversarial', ['0'])[0] in ['1', 'true']
+
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                payload = json.loads(body)
+                adversarial = adversarial or bool(payload.get('adversarial', False))
+
+                if 'logmel' in payload:
+                    feature = np.array(payload['logmel'], dtype=np.float32)
+
+                elif 'audio' in payload:
+                    feature = self.extract(base64.b64decode(payload['audio']))
+
+                else:
+                    raise ValueError("Payload has neither 'audio' nor 'logmel'")
+
+            else:
+                feature = self.extract(body)
+
+            if feature.ndim != 2 or feature.shape[1] != config.mel_bins or len(feature) == 0:
+                raise ValueError('Feature of shape {} is not (frames_num, {})'.format(
+                    feature.shape, config.mel_bins))
+
+        except Exception as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        # Repeat short features and cut long features to seq_len frames
+        feature = repeat_feature(feature, config.seq_len)[0 : config.seq_len]
+
+        try:
+            (probabilities, probabilities_adv) = self.server.batcher.predict(
+                feature, adversarial)
+
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+
+        result = self.get_result(probabilities)
+
+        if probabilities_adv is not None:
+            result['adversarial'] = self.get_result(probabilities_adv)
+
+        self.send_json(200, result)
+
+    def extract(self, wav_bytes):
+
+        (audio, fs) = read_audio(io.BytesIO(wav_bytes), target_fs=config.sample_rate)
+
+        return self.server.feature_extractor.transform(audio)
+
+    def get_result(self, probabilities):
+
+        return {'label': config.ix_to_lb[int(np.argmax(probabilities))],
+                'probabilities': {lb: float(probability) for (lb, probability)
+                                  in zip(config.labels, probabilities)}}
+
+    def send_json(self, code, obj):
+
+        body = json.dumps(obj).encode()
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+
+        logging.debug(format % args)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    # Clients send their requests at the same time to be batched, so the 
+    # listen queue holds more than the default 5 connections
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def run_server(predict_func, host, port, max_batch_size, max_latency):
+    """Serve predict_func over http until interrupted, see InferenceHandler
+    and MicroBatcher.
+    """
+
+    metrics = ServerMetrics()
+
+    server = InferenceServer((host, port), InferenceHandler)
+    server.metrics = metrics
+    server.batcher = MicroBatcher(predict_func=predict_func,
+                                  max_batch_size=max_batch_size,
+                                  max_latency=max_latency,
+                                  metrics=metrics)
+    server.feature_extractor = LogMelExtractor(sample_rate=config.sample_rate,
+                                               window_size=config.window_size,
+                                               overlap=config.overlap,
+                                               mel_bins=config.mel_bins)
+
+    logging.info('Serving on http://{}:{}'.format(host, port))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
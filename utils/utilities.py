@@ -10,6 +10,7 @@ import torch
 
 import config
 import librosa
+import soxr
 
 
 def create_folder(fd):
@@ -64,6 +65,41 @@ def read_audio(path, target_fs=None):
     return audio, fs
 
 
+def read_audio_blocks(path, block_size, target_fs=None):
+    """Read an audio block by block, so that the memory does not grow with 
+    the length of the audio. Resampling is streamed with the soxr resampler 
+    of librosa.resample. 
+    
+    Args:
+      path: str
+      block_size: int, number of samples read at once
+      target_fs: int | None
+      
+    Returns:
+      generator of 1d arrays
+    """
+    
+    fs = soundfile.info(path).samplerate
+    
+    if target_fs is not None and fs != target_fs:
+        resampler = soxr.ResampleStream(fs, target_fs, 1, dtype='float64')
+    else:
+        resampler = None
+        
+    for audio in soundfile.blocks(path, blocksize=block_size):
+        
+        if audio.ndim > 1:
+            audio = np.mean(audio, axis=1)
+            
+        if resampler is not None:
+            audio = resampler.resample_chunk(audio)
+            
+        yield audio
+        
+    if resampler is not None:
+        yield resampler.resample_chunk(np.zeros(0), last=True)
+
+
 def calculate_scalar(x):
 
     if x.ndim == 2:
@@ -77,6 +113,65 @@ def calculate_scalar(x):
     return mean, std
 
 
+class StreamingScalar(object):
+    def __init__(self):
+        """Streaming mean and standard deviation over the last axis. Chunks 
+        are merged with the parallel variant of Welford's algorithm (Chan et 
+        al.), so the data never has to be in memory at once and accumulators 
+        of different workers can be merged. 
+        """
+        
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        
+    def update(self, x):
+        """Add a chunk of data. 
+        
+        Args:
+          x: (..., freq_bins)
+        """
+        
+        x = x.reshape(-1, x.shape[-1]).astype(np.float64)
+        
+        if len(x) == 0:
+            return
+            
+        mean = np.mean(x, axis=0)
+        m2 = np.sum((x - mean) ** 2, axis=0)
+        
+        self.merge_moments(len(x), mean, m2)
+        
+    def merge(self, other):
+        
+        if other.count > 0:
+            self.merge_moments(other.count, other.mean, other.m2)
+        
+    def merge_moments(self, count, mean, m2):
+        
+        if self.count == 0:
+            (self.count, self.mean, self.m2) = (count, mean, m2)
+            return
+            
+        total = self.count + count
+        delta = mean - self.mean
+        
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        
+    def get_scalar(self):
+        """Returns:
+          mean: (freq_bins,)
+          std: (freq_bins,)
+        """
+        
+        mean = self.mean.astype(np.float32)
+        std = np.sqrt(self.m2 / self.count).astype(np.float32)
+        
+        return mean, std
+
+
 def scale(x, mean, std):
 
     return (x - mean) / std
@@ -93,33 +188,18 @@ def calculate_accuracy(target, predict, classes_num, average=None):
     Inputs:
       target: integer array, (audios_num,)
       predict: integer array, (audios_num,)
+      classes_num: int, number of classes
+      average: None | 'macro' | 'micro'
 
     Outputs:
-      accuracy: float
+      accuracy: (classes_num,) class-wise accuracy if average is None, 
+        float otherwise. 'macro' is the mean of the class-wise accuracy 
+        (unweighted average recall), 'micro' is the accuracy over all audios
     """
 
-    samples_num = len(target)
-    
-    correctness = np.zeros(classes_num)
-    total = np.zeros(classes_num)
-
-    for n in range(samples_num):
-        
-        total[target[n]] += 1
-        
-        if target[n] == predict[n]:
-            correctness[target[n]] += 1
-
-    accuracy = sum(correctness) / sum(total)
+    confusion_matrix = calculate_confusion_matrix(target, predict, classes_num)
 
-    # if average is None:
-    return accuracy
-        
-    # elif average == 'macro':
-    #     return np.mean(accuracy)
-        
-    # else:
-    #     raise Exception('Incorrect average!')
+    return accuracy_from_confusion_matrix(confusion_matrix, average)
 
 
 def calculate_confusion_matrix(target, predict, classes_num):
@@ -134,13 +214,67 @@ def calculate_confusion_matrix(target, predict, classes_num):
       confusion_matrix: (classes_num, classes_num)
     """
 
-    confusion_matrix = np.zeros((classes_num, classes_num))
-    samples_num = len(target)
+    target = np.asarray(target, dtype=np.int64)
+    predict = np.asarray(predict, dtype=np.int64)
+
+    confusion_matrix = np.bincount(target * classes_num + predict, 
+                                   minlength=classes_num * classes_num)
+
+    return confusion_matrix.reshape(classes_num, classes_num).astype(np.float64)
+
+
+def accuracy_from_confusion_matrix(confusion_matrix, average=None):
+    """Calculate accuracy from a confusion matrix. Classes without audios 
+    have nan class-wise accuracy and are left out of the 'macro' average.
+
+    Inputs:
+      confusion_matrix: (classes_num, classes_num), rows are targets
+      average: None | 'macro' | 'micro'
+
+    Outputs:
+      accuracy: (classes_num,) if average is None, float otherwise
+    """
+
+    correctness = np.diag(confusion_matrix)
+    total = np.sum(confusion_matrix, axis=-1)
+
+    if average is None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return correctness / total
+
+    elif average == 'macro':
+        present = total > 0
+        return float(np.mean(correctness[present] / total[present]))
+
+    elif average == 'micro':
+        return float(np.sum(correctness) / np.sum(total))
 
-    for n in range(samples_num):
-        confusion_matrix[target[n], predict[n]] += 1
+    else:
+        raise Exception('Incorrect average!')
 
-    return confusion_matrix
+
+def calculate_metrics(target, predict, classes_num):
+    """Calculate the confusion matrix and the accuracies in a single pass.
+
+    Inputs:
+      target: integer array, (audios_num,)
+      predict: integer array, (audios_num,)
+      classes_num: int, number of classes
+
+    Outputs:
+      dict, keys: 'confusion_matrix', 'class_wise_accuracy', 
+        'macro_accuracy', 'micro_accuracy'
+    """
+
+    confusion_matrix = calculate_confusion_matrix(target, predict, classes_num)
+
+    return {'confusion_matrix': confusion_matrix, 
+            'class_wise_accuracy': accuracy_from_confusion_matrix(
+                confusion_matrix, average=None), 
+            'macro_accuracy': accuracy_from_confusion_matrix(
+                confusion_matrix, average='macro'), 
+            'micro_accuracy': accuracy_from_confusion_matrix(
+                confusion_matrix, average='micro')}
 
 
 def print_accuracy(class_wise_accuracy, labels):
@@ -156,7 +290,7 @@ def print_accuracy(class_wise_accuracy, labels):
     for (n, label) in enumerate(labels):
         logging.info('{:<30}{:.3f}'.format(label, class_wise_accuracy[n]))
     logging.info('------------------------------------------------')
-    logging.info('{:<30}{:.3f}'.format('Average', np.mean(class_wise_accuracy)))
+    logging.info('{:<30}{:.3f}'.format('Average', np.nanmean(class_wise_accuracy)))
 
 def plot_confusion_matrix(confusion_matrix, title, labels, values, path):
     """Plot confusion matrix.
@@ -212,7 +346,16 @@ def write_leaderboard_submission(submission_path, audio_names, predictions):
     logging.info('Write result to {}'.format(submission_path))
     
      
-def write_evaluation_submission(submission_path, audio_names, predictions):
+def write_evaluation_submission(submission_path, audio_names, predictions, 
+                                probabilities=None):
+    """Write one line per audio: audio name, label and optionally the 
+    probabilities of all classes, separated by tabs. 
+    
+    Inputs:
+      audio_names: list of str
+      predictions: integer array, (audios_num,)
+      probabilities: (audios_num, classes_num) | None
+    """
     
     ix_to_lb = config.ix_to_lb
     
@@ -222,6 +365,11 @@ def write_evaluation_submission(submission_path, audio_names, predictions):
         f.write('audio/{}'.format(audio_names[n]))
         f.write('\t')
         f.write(ix_to_lb[predictions[n]])
+        
+        if probabilities is not None:
+            for probability in probabilities[n]:
+                f.write('\t{:.6f}'.format(probability))
+                
         f.write('\n')
         
     f.close()